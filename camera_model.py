@@ -0,0 +1,160 @@
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# Written by utils/calibrate_camera.py
+CALIBRATION_PATH = Path().cwd() / "camera_calibration.json"
+
+
+class LinearTableModel:
+    """Table position from a fixed scale per image axis.
+
+    Detections use image coordinates normalized to -0.5..0.5 with y up. The
+    table position is (forward, left) in meters in the frame of the camera
+    pan, forward being the direction the camera looks at.
+    """
+
+    def __init__(
+        self, mid_x_pos=0.14, length_per_pixel_x=0.098 * 2, length_per_pixel_y=0.138 * 2
+    ):
+        # length_per_pixel_x = 0.071 * 2
+        # length_per_pixel_y = 0.098 * 2
+        # mid_x_pos = 0.132
+        self.mid_x_pos = mid_x_pos
+        self.length_per_pixel_x = length_per_pixel_x
+        self.length_per_pixel_y = length_per_pixel_y
+
+    def to_table(self, x, y):
+        forward = self.mid_x_pos + np.asarray(y) * self.length_per_pixel_y
+        left = -np.asarray(x) * self.length_per_pixel_x
+        return forward, left
+
+
+class HomographyTableModel:
+    """Table position through a calibrated image to table homography.
+
+    homography maps undistorted pixel coordinates to (forward, left) in
+    meters on the table, for the camera pan at 0 degrees. With
+    camera_matrix and dist_coeffs the pixels are undistorted first.
+    """
+
+    def __init__(
+        self,
+        homography,
+        width=640,
+        height=480,
+        camera_matrix=None,
+        dist_coeffs=None,
+    ):
+        self.homography = np.asarray(homography, dtype=float)
+        self.width = width
+        self.height = height
+        self.camera_matrix = camera_matrix
+        self.dist_coeffs = dist_coeffs
+
+    @classmethod
+    def from_extrinsics(cls, camera_matrix, rvec, tvec, dist_coeffs=None, **kwargs):
+        """Model from intrinsics and the pose of the table plane.
+
+        rvec and tvec give the table frame (z = 0 on the table, x forward,
+        y left) in camera coordinates, as returned by cv2.solvePnP.
+        """
+        camera_matrix = np.asarray(camera_matrix, dtype=float)
+        rotation, _ = cv2.Rodrigues(np.asarray(rvec, dtype=float))
+        # Table points (X, Y, 0, 1) project with K [r1 r2 t]
+        table_to_image = camera_matrix @ np.column_stack(
+            [rotation[:, 0], rotation[:, 1], np.ravel(tvec)]
+        )
+        return cls(
+            np.linalg.inv(table_to_image),
+            camera_matrix=camera_matrix,
+            dist_coeffs=dist_coeffs,
+            **kwargs,
+        )
+
+    def to_table(self, x, y):
+        pixels = np.stack(
+            [
+                (np.asarray(x, dtype=float) + 0.5) * self.width,
+                (0.5 - np.asarray(y, dtype=float)) * self.height,
+            ],
+            axis=-1,
+        ).reshape(-1, 1, 2)
+        if self.camera_matrix is not None and self.dist_coeffs is not None:
+            pixels = cv2.undistortPoints(
+                pixels, self.camera_matrix, self.dist_coeffs, P=self.camera_matrix
+            )
+        table = cv2.perspectiveTransform(pixels, self.homography).reshape(-1, 2)
+        return table[:, 0], table[:, 1]
+
+
+def rotation_matrices(angles):
+    """2x2 rotations of the table plane for camera pan angles in degrees.
+
+    Every distinct angle is computed once. Returns [N, 2, 2].
+    """
+    unique, inverse = np.unique(np.asarray(angles, dtype=float), return_inverse=True)
+    theta = np.deg2rad(unique)
+    cos, sin = np.cos(theta), np.sin(theta)
+    rotations = np.stack([np.stack([cos, -sin], -1), np.stack([sin, cos], -1)], 1)
+    return rotations[inverse.reshape(-1)]
+
+
+def camera_to_world(model, x, y, angles):
+    """Map normalized image coordinates seen at camera pan angles (degrees)
+    to global (x, y) on the table. Returns two arrays."""
+    forward, left = model.to_table(x, y)
+    local = np.stack([np.ravel(forward), np.ravel(left)], axis=1)
+    world = np.einsum("nij,nj->ni", rotation_matrices(angles), local)
+    return world[:, 0], world[:, 1]
+
+
+class Undistorter:
+    """Removes lens distortion with maps precomputed once, so every frame
+    costs a single cv2.remap. The camera matrix is kept, pixel scale and
+    center do not change."""
+
+    def __init__(self, camera_matrix, dist_coeffs, size):
+        self.size = tuple(size)
+        self.map1, self.map2 = cv2.initUndistortRectifyMap(
+            camera_matrix, dist_coeffs, None, camera_matrix, self.size, cv2.CV_16SC2
+        )
+
+    def __call__(self, frame, out=None):
+        return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR, dst=out)
+
+
+def save_calibration(
+    camera_matrix, dist_coeffs, homography, size, rms=None, path=CALIBRATION_PATH
+):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    calibration = {
+        "image_size": [int(v) for v in size],
+        "camera_matrix": np.asarray(camera_matrix).tolist(),
+        "dist_coeffs": np.ravel(dist_coeffs).tolist(),
+        # Maps undistorted pixels to (forward, left) at camera angle 0
+        "homography": np.asarray(homography).tolist(),
+        "rms": rms,
+    }
+    with open(path, "w") as f:
+        json.dump(calibration, f, indent=2)
+    return path
+
+
+def load_calibration(path=CALIBRATION_PATH):
+    """Calibration saved by save_calibration, None if there is no file."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        calibration = json.load(f)
+    return {
+        "image_size": tuple(calibration["image_size"]),
+        "camera_matrix": np.array(calibration["camera_matrix"], dtype=float),
+        "dist_coeffs": np.array(calibration["dist_coeffs"], dtype=float),
+        "homography": np.array(calibration["homography"], dtype=float),
+        "rms": calibration.get("rms"),
+    }
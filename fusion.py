@@ -0,0 +1,172 @@
+from collections import Counter
+from dataclasses import replace
+from typing import List
+
+import numpy as np
+
+from vision import CameraDetection
+
+# Squared Mahalanobis distance inside which 99% of the observations of an
+# object fall (chi-squared, 2 degrees of freedom)
+GATE_99 = 9.21
+
+
+class Track:
+    """One object seen in several views.
+
+    Keeps the confidence weighted running mean and covariance of its table
+    position, votes for color and shape and the most confident detection.
+    """
+
+    def __init__(self, detection: CameraDetection):
+        self.observations = 0
+        self.weight = 0.0
+        self.mean = np.zeros(2)
+        self._m2 = np.zeros((2, 2))
+        self.z = 0.0
+        self.size = 0.0
+        self.colors = Counter()
+        self.shapes = Counter()
+        # Probability that every detection of this track is wrong
+        self._miss = 1.0
+        self.best = detection
+        self.update(detection)
+
+    @property
+    def covariance(self):
+        return self._m2 / self.weight
+
+    def update(self, detection: CameraDetection):
+        w = max(detection.confidence, 1e-6)
+        position = np.array([detection.global_x, detection.global_y])
+        self.observations += 1
+        self.weight += w
+        # Weighted Welford update
+        delta = position - self.mean
+        self.mean = self.mean + w / self.weight * delta
+        self._m2 += w * np.outer(delta, position - self.mean)
+        self.z += w / self.weight * (detection.global_z - self.z)
+        self.size += w / self.weight * (detection.size - self.size)
+        self.colors[detection.color] += w
+        self.shapes[detection.shape] += w
+        self._miss *= 1 - min(detection.confidence, 1.0)
+        if detection.confidence > self.best.confidence:
+            self.best = detection
+
+    def vote(self, votes):
+        """Winning class and its share of the votes."""
+        label, count = votes.most_common(1)[0]
+        return label, count / sum(votes.values())
+
+    @property
+    def confidence(self):
+        _, color_share = self.vote(self.colors)
+        _, shape_share = self.vote(self.shapes)
+        return color_share * shape_share * (1 - self._miss)
+
+    def to_detection(self) -> CameraDetection:
+        color, _ = self.vote(self.colors)
+        shape, _ = self.vote(self.shapes)
+        return replace(
+            self.best,
+            color=color,
+            shape=shape,
+            confidence=float(self.confidence),
+            global_x=float(self.mean[0]),
+            global_y=float(self.mean[1]),
+            global_z=float(self.z),
+            size=float(self.size),
+        )
+
+
+class DetectionFusion:
+    """Fuses the detections of a scan into one object per track.
+
+    Call update() with the detections of each view. Detections are matched
+    to tracks by Mahalanobis distance on the table, using the spread of the
+    track plus measurement_noise (meters), and never further than
+    max_distance. Disagreeing color or shape makes a match more expensive
+    but does not forbid it, so a misclassified view is outvoted instead of
+    creating a duplicate.
+    """
+
+    def __init__(
+        self,
+        measurement_noise=0.03,
+        max_distance=0.08,
+        label_penalty=2.0,
+        position_tolerance=0.01,
+        min_vote_share=0.6,
+    ):
+        self.measurement_noise = measurement_noise
+        self.max_distance = max_distance
+        self.label_penalty = label_penalty
+        self.position_tolerance = position_tolerance
+        self.min_vote_share = min_vote_share
+        self.tracks: List[Track] = []
+        self.views = 0
+        self.new_tracks = 0
+
+    def _cost(self, track: Track, detection: CameraDetection):
+        delta = np.array([detection.global_x, detection.global_y]) - track.mean
+        if np.hypot(*delta) > self.max_distance:
+            return None
+        spread = track.covariance + self.measurement_noise**2 * np.eye(2)
+        cost = float(delta @ np.linalg.solve(spread, delta))
+        if cost > GATE_99:
+            return None
+        if track.vote(track.colors)[0] != detection.color:
+            cost += self.label_penalty
+        if track.vote(track.shapes)[0] != detection.shape:
+            cost += self.label_penalty
+        return cost
+
+    def update(self, detections: List[CameraDetection]):
+        """Add the detections of one view, each track takes at most one."""
+        candidates = []
+        for d, detection in enumerate(detections):
+            for t, track in enumerate(self.tracks):
+                cost = self._cost(track, detection)
+                if cost is not None:
+                    candidates.append((cost, d, t))
+
+        # Cheapest pairs first
+        matched_detections, matched_tracks = set(), set()
+        for _, d, t in sorted(candidates):
+            if d in matched_detections or t in matched_tracks:
+                continue
+            self.tracks[t].update(detections[d])
+            matched_detections.add(d)
+            matched_tracks.add(t)
+
+        self.new_tracks = 0
+        for d, detection in enumerate(detections):
+            if d not in matched_detections:
+                self.tracks.append(Track(detection))
+                self.new_tracks += 1
+        self.views += 1
+
+    def is_track_stable(self, track: Track):
+        if track.observations < 2:
+            return False
+        standard_error = np.sqrt(np.trace(track.covariance) / track.observations)
+        return (
+            standard_error < self.position_tolerance
+            and track.vote(track.colors)[1] >= self.min_vote_share
+            and track.vote(track.shapes)[1] >= self.min_vote_share
+        )
+
+    def is_stable(self, expected_objects):
+        """True once expected_objects tracks have settled position and labels
+        and the last view started no new track."""
+        stable = sum(self.is_track_stable(track) for track in self.tracks)
+        return self.new_tracks == 0 and stable >= expected_objects
+
+    def objects(self, min_observations=1) -> List[CameraDetection]:
+        """One detection per track, sorted by position."""
+        objects = [
+            track.to_detection()
+            for track in self.tracks
+            if track.observations >= min_observations
+        ]
+        return sorted(objects, key=lambda o: (o.global_x, o.global_y))
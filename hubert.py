@@ -1,14 +1,23 @@
 from dataclasses import dataclass
-import time
+import queue
+import threading
 from typing import List
 import numpy as np
 from inverse_kinematics import (
+    IKCache,
+    WorkspaceLookup,
+    analytic_inverse_kinematics,
     dumb_but_optimized_inverse_kinematics,
     forward_kinematics,
+    hierarchical_inverse_kinematics,
+    inverse_kinematics_batch,
 )
 from audio_interface import AudioInterface
 from vision import Camera, CameraDetection
+from fusion import DetectionFusion
 from utils.serial_communication import ArduinoSerial
+from trajectory import plan_trajectory, stream_trajectory
+from utils.background import BackgroundLoader
 import cv2
 
 
@@ -20,10 +29,40 @@ class Position:
 
 
 class Hubert:
-    def __init__(self, mock=False, camera_index=1):
-        self._arduino = ArduinoSerial(mock=mock)
+    def __init__(
+        self,
+        mock=False,
+        camera_index=1,
+        ik_method="lookup",
+        ik_cache_resolution=0.001,
+        pipeline=False,
+        smooth_moves=False,
+        connect_in_background=False,
+    ):
+        self._arduino = ArduinoSerial(
+            mock=mock, connect_in_background=connect_in_background
+        )
+        # When pipelining, moves are queued on the serial I/O thread and the
+        # caller only blocks in wait_for_moves()
+        self.pipeline = pipeline
+        # Pick up and drop off moves are streamed as interpolated waypoints.
+        # Off by default, the firmware interpolates every command itself and
+        # takes ~150 ms per command, so streaming makes moves slower.
+        self.smooth_moves = smooth_moves
+        self.max_joint_velocity = 30.0
+        self.max_joint_acceleration = 60.0
+        self.trajectory_rate = 20.0
+        self.ik_method = ik_method
+        # The workspace is built (or loaded) in the background, the voice
+        # only when first needed
+        self._ik_lookup = BackgroundLoader(
+            "workspace lookup", WorkspaceLookup, start=ik_method == "lookup"
+        )
+        self.ik_cache = IKCache(resolution=ik_cache_resolution)
         self._angles = np.array([0, 0, 0])
-        self._voice = AudioInterface()
+        # The real arm pose is unknown until the first move has been sent
+        self._angles_known = False
+        self._voice_loader = BackgroundLoader("voice", AudioInterface, start=False)
         self.position = np.array([0.1, -0.1, 0.3])
 
         self.static_positions = {
@@ -31,9 +70,31 @@ class Hubert:
             "2": Position(x=0.13, y=0.08, z=0.02),
             "dropoff": Position(x=0.3, y=0, z=0.02),
         }
+        self.drop_off_positions = [
+            (0.18, 0.15, 0.03),
+            (0.165, 0.155, 0.06),
+            (0.14, 0.1, 0.12),
+        ]
         self.sort_mode = None
         self.sort_order = None
 
+    @property
+    def _voice(self):
+        return self._voice_loader.get()
+
+    def readiness(self):
+        """Status of every part that is initialized in the background."""
+        return {
+            "arm": self._arduino.status,
+            "inverse kinematics": self._ik_lookup.status,
+            "voice": self._voice_loader.status,
+        }
+
+    def is_ready(self):
+        return self._arduino.is_ready() and (
+            self.ik_method != "lookup" or self._ik_lookup.ready
+        )
+
     @property
     def angles(self):
         return self._angles
@@ -41,8 +102,45 @@ class Hubert:
     @angles.setter
     def angles(self, angles):
         self._angles = np.array(angles)
+        self._angles_known = True
         self._arduino.set_angles(self._angles)
-        self._arduino.send_to_arduino(wait_for_reply=True)
+        if self.pipeline:
+            self._arduino.send_async()
+        else:
+            self._arduino.send_to_arduino(wait_for_reply=True)
+
+    def move_async(self, angles):
+        """Queue a move without waiting, returns the future of its reply."""
+        self._angles = np.array(angles)
+        self._angles_known = True
+        self._arduino.set_angles(self._angles)
+        return self._arduino.send_async()
+
+    def wait_for_moves(self, timeout=None):
+        self._arduino.flush(timeout)
+
+    def move_to(self, angles, profile="trapezoidal"):
+        """Move smoothly to angles (degrees).
+
+        Returns as soon as the Arduino acknowledges the last waypoint. The
+        waypoint rate is limited to what the firmware can acknowledge, moves
+        are sent directly without smooth_moves or in mock mode.
+        """
+        if not self.smooth_moves or not self._angles_known or self._arduino.mock:
+            self.angles = angles
+            self.wait_for_moves()
+            return
+        self.wait_for_moves()
+        times, waypoints = plan_trajectory(
+            self._angles,
+            angles,
+            max_velocity=self.max_joint_velocity,
+            max_acceleration=self.max_joint_acceleration,
+            rate=min(self.trajectory_rate, 1 / self._arduino.command_time),
+            profile=profile,
+        )
+        stream_trajectory(self._arduino, times, waypoints)
+        self._angles = np.array(angles)
 
     def set_sort_mode(self):
         self.sort_mode = None
@@ -68,46 +166,47 @@ class Hubert:
     def set_camera_position(self):
         self._arduino.set_camera_position()
 
-    def action_pick_up(self, x, y, z) -> bool:
+    def action_pick_up(self, x, y, z, angles=None) -> bool:
         # print("Picking up object at", x, y, z)
-        theta1, theta2, theta3 = self.inverse_kinematics(x, y, z)
+        if angles is None:
+            angles = self.inverse_kinematics(x, y, z)
+        theta1, theta2, theta3 = angles
         print("Calculated angles", theta1, theta2, theta3)
 
         # print("Moving to pick up object")
         # Ensure we are not close to ground level.
 
-        self.angles = (theta1, 120, -85)
+        self.move_to((theta1, 120, -85))
 
         # print(self.angles)
         # print("Lowering arm")
         # Lower arm
         self._arduino.open_gripper()
-        self.angles = (self.angles[0], theta2 - 5, theta3)
+        self.move_to((self.angles[0], theta2 - 5, theta3))
         # print("Opening gripper")
         # self.angles = (self.angles[0], theta2 - 5, self.angles[2])
         # Close gripper
-        time.sleep(2)
         self._arduino.close_gripper()
         # self.angles = (self.angles[0], 65, -80)
 
         # # self.angles = (self.angles[0], 65, self.angles[2])
-        self.angles = (self.angles[0], self.angles[1] + 10, self.angles[2])
-        self.angles = (self.angles[0], self.angles[1], -60)
-        self.angles = (self.angles[0], 65, self.angles[2])
+        self.move_to((self.angles[0], self.angles[1] + 10, self.angles[2]))
+        self.move_to((self.angles[0], self.angles[1], -60))
+        self.move_to((self.angles[0], 65, self.angles[2]))
         self.open_gripper()
         self.close_gripper()
         # Raise arm
         # print("Here1")
-        self.angles = (self.angles[0], 120, -85)
+        self.move_to((self.angles[0], 120, -85))
         # self.angles = (self.angles[0], self.angles[1], -85)
 
         return True
 
-    def action_drop_off(self, idx: int, position: int):
-        drop_off_pos = [(0.18, 0.15, 0.03), (0.165, 0.155, 0.06), (0.14, 0.1, 0.12)]
-
-        x, y, z = drop_off_pos[idx]
-        theta1, theta2, theta3 = self.inverse_kinematics(x, y, z)
+    def action_drop_off(self, idx: int, position: int, angles=None):
+        if angles is None:
+            x, y, z = self.drop_off_positions[idx]
+            angles = self.inverse_kinematics(x, y, z)
+        theta1, theta2, theta3 = angles
         if position == 0:
             # print("hello")
             theta1 = 66
@@ -122,12 +221,12 @@ class Hubert:
 
         # print("Moving to drop off object")
         # Ensure we are not close to ground level.
-        self.angles = (theta1, 120, -85)
+        self.move_to((theta1, 120, -85))
 
         # print(self.angles)
         # print("Lowering arm")
         # Lower arm
-        self.angles = (self.angles[0], theta2, theta3)
+        self.move_to((self.angles[0], theta2, theta3))
         # self.angles = (self.angles[0], theta2, self.angles[2])
         # self.angles = (self.angles[0], self.angles[1], theta3)
         # print("Opening gripper")
@@ -136,37 +235,217 @@ class Hubert:
         # Close gripper
 
         # Raise arm
-        self.angles = (self.angles[0], 120, -85)
+        self.move_to((self.angles[0], 120, -85))
         # self.angles = (self.angles[0], self.angles[1], -85)
         self._arduino.close_gripper()
 
         return True
 
     def inverse_kinematics(self, x, y, z):
-        return dumb_but_optimized_inverse_kinematics(x, y, z)
+        key = self.ik_cache.key(self.ik_method, x, y, z)
+        angles = self.ik_cache.get(key)
+        if angles is None:
+            angles = self._solve_inverse_kinematics(*self.ik_cache.quantize(x, y, z))
+            self.ik_cache.put(key, angles)
+        return angles
+
+    def _solve_inverse_kinematics(self, x, y, z):
+        if self.ik_method == "lookup":
+            return self._ik_lookup.get().inverse_kinematics(x, y, z)
+        elif self.ik_method == "analytic":
+            angles, reachable = analytic_inverse_kinematics(x, y, z)
+            if not reachable:
+                print("Warn: Target out of reach - ", x, y, z)
+            return angles
+        elif self.ik_method == "hierarchical":
+            angles, _ = hierarchical_inverse_kinematics(x, y, z)
+            return angles
+        elif self.ik_method == "grid":
+            return dumb_but_optimized_inverse_kinematics(x, y, z)
+        raise ValueError(f"Unknown IK method: {self.ik_method}")
+
+    def inverse_kinematics_batch(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        keys = [self.ik_cache.key(self.ik_method, *point) for point in points]
+        cached = [self.ik_cache.get(key) for key in keys]
+        missing = [i for i, angles in enumerate(cached) if angles is None]
+        angles = np.array(
+            [a if a is not None else (np.nan,) * 3 for a in cached], dtype=float
+        ).reshape(-1, 3)
+        if missing:
+            quantized = [self.ik_cache.quantize(*points[i]) for i in missing]
+            angles[missing] = self._solve_inverse_kinematics_batch(quantized)
+            for i in missing:
+                self.ik_cache.put(keys[i], angles[i])
+        return angles
+
+    def _solve_inverse_kinematics_batch(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if self.ik_method == "lookup":
+            angles, _ = self._ik_lookup.get().query_batch(points)
+            return angles
+        elif self.ik_method == "analytic":
+            angles, _ = inverse_kinematics_batch(points)
+            return angles
+        elif self.ik_method in ("hierarchical", "grid"):
+            return np.array(
+                [self._solve_inverse_kinematics(*point) for point in points]
+            )
+        raise ValueError(f"Unknown IK method: {self.ik_method}")
+
+    def plan_sort(self, sorted_objects: List[List[CameraDetection]], z_offset=0.02):
+        """Solve IK for all pick ups and drop offs of a sort in one batch.
+
+        Returns pick up angles with the same nesting as sorted_objects and
+        one angle triple per drop off slot.
+        """
+        picks = [
+            (obj.global_x, obj.global_y, obj.global_z + z_offset)
+            for objects in sorted_objects
+            for obj in objects
+        ]
+        angles = self.inverse_kinematics_batch(picks + self.drop_off_positions)
+        angles = [tuple(float(a) for a in row) for row in angles]
+        pick_angles = []
+        start = 0
+        for objects in sorted_objects:
+            pick_angles.append(angles[start : start + len(objects)])
+            start += len(objects)
+        drop_off_angles = angles[start:]
+        return pick_angles, drop_off_angles
+
+    def save_ik_cache(self):
+        self.ik_cache.save()
+        print(
+            f"IK cache saved: {len(self.ik_cache)} entries, "
+            f"{self.ik_cache.hits} hits, {self.ik_cache.misses} misses"
+        )
 
     def forward_kinematics(self, theta1, theta2, theta3):
         return forward_kinematics(theta1, theta2, theta3)
 
     def close_gripper(self):
-        self._arduino.close_gripper()
+        self._arduino.close_gripper(wait=not self.pipeline)
 
     def open_gripper(self):
-        self._arduino.open_gripper()
+        self._arduino.open_gripper(wait=not self.pipeline)
+
+    def detect_objects(
+        self, camera: Camera, mode="sequential", fuse=True, expected_objects=None
+    ) -> List[CameraDetection]:
+        """Scan the table and return one detection per object.
 
-    def detect_objects(self, camera: Camera) -> List[CameraDetection]:
+        With fuse the views are combined by DetectionFusion, otherwise with
+        merge_objects. Given expected_objects, the sequential and pipelined
+        scans stop as soon as that many objects have stable tracks.
+        """
         self.set_camera_position()
-        camera_detections = []
-        # for i in [-40]:
+        fusion = DetectionFusion() if fuse else None
+        if mode == "batch":
+            views = self._detect_objects_batch(camera)
+            if fusion is not None:
+                for view in views:
+                    fusion.update(view)
+        elif mode == "pipelined":
+            views = self._detect_objects_pipelined(camera, fusion, expected_objects)
+        elif mode == "sequential":
+            views = self._detect_objects_sequential(camera, fusion, expected_objects)
+        else:
+            raise ValueError(f"Unknown scan mode: {mode}")
+
+        if fusion is None:
+            camera_detections = [d for view in views for d in view]
+            return camera.merge_objects(camera_detections, distance_threshold=0.08)
+        print(
+            f"Fused {sum(map(len, views))} detections into {len(fusion.tracks)} objects"
+        )
+        return fusion.objects()
+
+    def _scan_stable(self, fusion, expected_objects):
+        return (
+            fusion is not None
+            and expected_objects is not None
+            and fusion.is_stable(expected_objects)
+        )
+
+    def _grab_scan_frame(self, camera: Camera, angle):
+        """Frame seen with the camera panned to angle."""
+        self.update_angles(angle, 90, -85)
+        # With pipeline the move is only queued, a frame grabbed before it is
+        # acknowledged still shows the previous pose
+        self.wait_for_moves()
+        return camera.grab_settled_frame(max_wait=1.0)
+
+    def _detect_objects_sequential(self, camera: Camera, fusion, expected_objects):
+        views = []
         for i in np.arange(-40, 40, 10, dtype=int):
-            self.update_angles(i, 90, -85)
-            time.sleep(1)
-            frame = camera.grab_frame()
-            camera_detections.extend(
-                camera.get_detected_objects_from_nn(frame=frame, angle=i)
-            )
+            frame = self._grab_scan_frame(camera, i)
+            views.append(camera.get_detected_objects_from_nn(frame=frame, angle=i))
+            if fusion is not None:
+                fusion.update(views[-1])
+            if self._scan_stable(fusion, expected_objects):
+                print(f"Scan stable after {len(views)} views")
+                break
         cv2.destroyAllWindows()
-        return camera.merge_objects(camera_detections, distance_threshold=0.08)
+        return views
+
+    def _detect_objects_batch(self, camera: Camera):
+        # Only capture during the sweep, then run the detector once on all
+        # frames while the arm heads back to the home pose
+        frames = []
+        angles = []
+        for i in np.arange(-40, 40, 10, dtype=int):
+            frames.append(self._grab_scan_frame(camera, i))
+            angles.append(i)
+        home = self.move_async((0, 90, -85))
+        camera_detections = camera.get_detected_objects_from_nn_batch(frames, angles)
+        home.result()
+        # One view per scan angle, in scan order
+        return [[d for d in camera_detections if d.angle == i] for i in angles]
+
+    def _detect_objects_pipelined(self, camera: Camera, fusion, expected_objects):
+        # A worker thread runs the detector on frame N while the arm rotates
+        # to angle N + 1, so each step costs about max(motion, inference)
+        frames = queue.Queue()
+        views = []
+        stable = threading.Event()
+        # An error in the worker ends the sweep and is raised after it
+        errors = []
+
+        def detect():
+            while True:
+                item = frames.get()
+                if item is None:
+                    return
+                frame, angle = item
+                try:
+                    views.append(
+                        camera.get_detected_objects_from_nn(
+                            frame=frame, angle=angle, show=False
+                        )
+                    )
+                    if fusion is not None:
+                        fusion.update(views[-1])
+                    if self._scan_stable(fusion, expected_objects):
+                        stable.set()
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        worker = threading.Thread(target=detect, daemon=True)
+        worker.start()
+        for i in np.arange(-40, 40, 10, dtype=int):
+            if errors:
+                break
+            if stable.is_set():
+                print("Scan stable, stopping early")
+                break
+            frames.put((self._grab_scan_frame(camera, i), i))
+        frames.put(None)
+        worker.join()
+        if errors:
+            raise errors[0]
+        return views
 
     def get_sorted_objects(
         self,
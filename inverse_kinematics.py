@@ -1,5 +1,475 @@
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+
 import numpy as np
 
+# length parameters of robot
+L1 = 0.14
+L2 = 0.055
+L3 = 0.045
+L4 = 0.108
+L5 = 0.005
+L6 = 0.034
+L7 = 0.015
+L8 = 0.088
+L9 = 0.204
+
+# Joint limits in degrees, same grid as dumb_but_optimized_inverse_kinematics
+THETA0_LIMITS = (-90, 90)
+THETA1_LIMITS = (30, 180)
+THETA2_LIMITS = (-90, -1)
+_LOWER_LIMITS = np.array([THETA0_LIMITS[0], THETA1_LIMITS[0], THETA2_LIMITS[0]])
+_UPPER_LIMITS = np.array([THETA0_LIMITS[1], THETA1_LIMITS[1], THETA2_LIMITS[1]])
+
+WORKSPACE_CACHE_PATH = Path().cwd() / "neural_network" / "weights" / "ik_workspace.npz"
+IK_CACHE_PATH = Path().cwd() / "neural_network" / "weights" / "ik_cache.json"
+
+
+def _geometry():
+    # Link lengths and joint limits, cached solutions are only valid for these
+    return [L1, L2, L3, L4, L5, L6, L7, L8, L9] + list(
+        THETA0_LIMITS + THETA1_LIMITS + THETA2_LIMITS
+    )
+
+
+def _forward_kinematics(theta0, theta1, theta2):
+    # Same chain as forward_kinematics with x3 = y3 = z3 = 0, works on arrays
+    # and does not print.
+    x2 = np.sin(theta2) * L9
+    y2 = -np.cos(theta2) * L9
+
+    x1 = np.cos(theta1) * (x2 + L7) - np.sin(theta1) * (y2 - L8)
+    y1 = np.sin(theta1) * (x2 + L7) + np.cos(theta1) * (y2 - L8)
+    z1 = -L5
+
+    x0 = np.cos(theta0) * (x1 + L6) - np.sin(theta0) * (-z1 - L4)
+    y0 = np.sin(theta0) * (x1 + L6) + np.cos(theta0) * (-z1 - L4)
+    z0 = y1 + (L2 + L3) + L1
+    return x0, y0, z0
+
+
+class WorkspaceLookup:
+    """Nearest-neighbour inverse kinematics over a precomputed workspace.
+
+    The forward kinematics of every 1 degree joint combination is computed
+    once and cached on disk, queries then go through a KD-tree. The cache is
+    rebuilt when the link lengths, joint limits or step change.
+    """
+
+    def __init__(self, cache_path=WORKSPACE_CACHE_PATH, step=1):
+        self.cache_path = Path(cache_path)
+        self.step = step
+        self.theta0_range = np.arange(THETA0_LIMITS[0], THETA0_LIMITS[1] + 1, step)
+        self.theta1_range = np.arange(THETA1_LIMITS[0], THETA1_LIMITS[1] + 1, step)
+        self.theta2_range = np.arange(THETA2_LIMITS[0], THETA2_LIMITS[1] + 1, step)
+        self.shape = (
+            len(self.theta0_range),
+            len(self.theta1_range),
+            len(self.theta2_range),
+        )
+        self.points = self._load_or_build()
+        from scipy.spatial import cKDTree
+
+        self.tree = cKDTree(self.points)
+
+    def _build(self):
+        # Build one theta0 slice at a time to keep peak memory low
+        theta1_grid, theta2_grid = np.meshgrid(
+            np.deg2rad(self.theta1_range),
+            np.deg2rad(self.theta2_range),
+            indexing="ij",
+        )
+        points = np.empty(self.shape + (3,), dtype=np.float32)
+        for i, theta0 in enumerate(np.deg2rad(self.theta0_range)):
+            x0, y0, z0 = _forward_kinematics(theta0, theta1_grid, theta2_grid)
+            points[i, ..., 0] = x0
+            points[i, ..., 1] = y0
+            points[i, ..., 2] = z0
+        return points.reshape(-1, 3)
+
+    def _parameters(self):
+        # Everything the cached points depend on
+        return np.array(_geometry() + [self.step], dtype=float)
+
+    def _load_or_build(self):
+        parameters = self._parameters()
+        if self.cache_path.exists():
+            try:
+                with np.load(self.cache_path) as cache:
+                    if np.array_equal(cache["parameters"], parameters):
+                        return cache["points"]
+                print("Workspace cache is out of date, rebuilding")
+            except (OSError, KeyError, ValueError) as e:
+                print("Could not read workspace cache, rebuilding: " + str(e))
+        points = self._build()
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(self.cache_path, points=points, parameters=parameters)
+        except OSError as e:
+            print("Could not save workspace cache: " + str(e))
+        return points
+
+    def query(self, x, y, z):
+        dist, index = self.tree.query((x, y, z))
+        i, j, k = np.unravel_index(index, self.shape)
+        return (
+            float(self.theta0_range[i]),
+            float(self.theta1_range[j]),
+            float(self.theta2_range[k]),
+        ), float(dist)
+
+    def inverse_kinematics(self, x, y, z):
+        angles, _ = self.query(x, y, z)
+        return angles
+
+    def query_batch(self, points):
+        dist, index = self.tree.query(np.asarray(points, dtype=float).reshape(-1, 3))
+        i, j, k = np.unravel_index(index, self.shape)
+        angles = np.column_stack(
+            [self.theta0_range[i], self.theta1_range[j], self.theta2_range[k]]
+        ).astype(float)
+        return angles, dist
+
+
+class IKCache:
+    """LRU cache of inverse kinematics solutions.
+
+    Targets are quantized to resolution (meters) and solved at the center of
+    their cell, so a cached answer is exact for every target in the cell.
+    Entries are kept per IK method and can be saved to disk, a saved cache
+    is ignored when the resolution, link lengths or joint limits changed.
+    """
+
+    def __init__(self, resolution=0.001, max_size=4096, path=IK_CACHE_PATH):
+        self.resolution = resolution
+        self.max_size = max_size
+        self.path = Path(path) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self.load()
+
+    def key(self, method, x, y, z):
+        return (method,) + tuple(
+            int(round(value / self.resolution)) for value in (x, y, z)
+        )
+
+    def quantize(self, x, y, z):
+        return tuple(
+            round(value / self.resolution) * self.resolution for value in (x, y, z)
+        )
+
+    def get(self, key):
+        angles = self._entries.get(key)
+        if angles is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return angles
+
+    def put(self, key, angles):
+        self._entries[key] = tuple(float(a) for a in angles)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("resolution") != self.resolution:
+                print("IK cache resolution changed, ignoring " + str(self.path))
+                return
+            if data.get("geometry") != _geometry():
+                print("IK cache geometry changed, ignoring " + str(self.path))
+                return
+            for entry in data["entries"]:
+                self.put((entry["method"], *entry["key"]), entry["angles"])
+        except (OSError, ValueError, KeyError) as e:
+            print("Could not read IK cache, starting empty: " + str(e))
+            self._entries.clear()
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            "resolution": self.resolution,
+            "geometry": _geometry(),
+            "entries": [
+                {"method": key[0], "key": list(key[1:]), "angles": list(angles)}
+                for key, angles in self._entries.items()
+            ],
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write a copy and swap it in, so an interrupted save never leaves a
+        # half written cache
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump(data, f)
+        os.replace(temporary, self.path)
+
+
+def _wrap_degrees(angle):
+    return (angle + 180) % 360 - 180
+
+
+def _clip_to_limits(angles):
+    return np.clip(angles, _LOWER_LIMITS, _UPPER_LIMITS)
+
+
+def _residuals(points, angles):
+    return np.linalg.norm(
+        forward_kinematics_batch(angles, degrees=True) - points, axis=-1
+    )
+
+
+def _jacobian(theta, step=1e-6):
+    # Numerical jacobian of the end effector positions w.r.t. the joint angles
+    # (radians) for N configurations, shape [N, 3, 3].
+    base = forward_kinematics_batch(theta)
+    J = np.empty(theta.shape + (3,))
+    for joint in range(3):
+        shifted = theta.copy()
+        shifted[:, joint] += step
+        J[:, :, joint] = (forward_kinematics_batch(shifted) - base) / step
+    return J
+
+
+def _refine_batch(points, angles, iterations=10, tolerance=1e-6):
+    # Damped Gauss-Newton on all rows at once. Angles are clipped to the joint
+    # limits after every step, joints already on a limit that the step would
+    # push further out get their jacobian column zeroed so they stay fixed
+    # while the remaining joints are solved for.
+    theta = np.deg2rad(_clip_to_limits(angles))
+    best_theta = theta.copy()
+    best_residual = np.full(len(points), np.inf)
+    damping = 1e-6 * np.eye(3)
+    for _ in range(iterations + 1):
+        error = points - forward_kinematics_batch(theta)
+        residual = np.linalg.norm(error, axis=-1)
+        improved = residual < best_residual
+        best_theta[improved] = theta[improved]
+        best_residual[improved] = residual[improved]
+        active = residual >= tolerance
+        if not active.any():
+            break
+        J = _jacobian(theta)
+        JT = J.transpose(0, 2, 1)
+        step = np.linalg.solve(JT @ J + damping, (JT @ error[..., None]))[..., 0]
+        degrees = np.rad2deg(theta)
+        at_limit = _clip_to_limits(degrees + np.rad2deg(step)) == degrees
+        if at_limit.any():
+            J = J * ~at_limit[:, None, :]
+            JT = J.transpose(0, 2, 1)
+            step = np.linalg.solve(JT @ J + damping, (JT @ error[..., None]))[..., 0]
+        step[~active] = 0
+        theta = np.deg2rad(_clip_to_limits(np.rad2deg(theta + step)))
+    return np.rad2deg(best_theta), best_residual
+
+
+def _analytic_batch(points):
+    # Closed form solution for all rows. Returns the best joint limited
+    # candidate per row and its residual.
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+
+    # Body yaw. In the body frame the wrist plane is offset by c from the
+    # rotation axis, so (x, y) = Rot(theta0) @ (r, c). The wrist can be in
+    # front of (r > 0) or behind (r < 0) the yaw axis.
+    c = L5 - L4
+    r_abs = np.sqrt(np.maximum(x**2 + y**2 - c**2, 0.0))
+    R = np.sqrt(L7**2 + L8**2)
+    phi = np.arctan2(L8, L7)
+
+    candidates = []
+    for r in (r_abs, -r_abs):
+        theta0 = np.arctan2(y, x) - np.arctan2(c, r)
+
+        # Planar two link problem for shoulder and elbow. The elbow link is
+        # (L7 + L9 sin(theta2), -L8 - L9 cos(theta2)) in the shoulder frame,
+        # its length only depends on theta2.
+        px = r - L6
+        py = z - (L1 + L2 + L3)
+        s = (px**2 + py**2 - L7**2 - L8**2 - L9**2) / (2 * L9 * R)
+        s = np.clip(s, -1.0, 1.0)
+
+        for theta2 in (np.arcsin(s) - phi, np.pi - np.arcsin(s) - phi):
+            a = L7 + L9 * np.sin(theta2)
+            b = -L8 - L9 * np.cos(theta2)
+            theta1 = np.arctan2(py, px) - np.arctan2(b, a)
+            candidates.append(
+                np.stack(
+                    [
+                        _wrap_degrees(np.rad2deg(theta0)),
+                        np.rad2deg(theta1) % 360,
+                        _wrap_degrees(np.rad2deg(theta2)),
+                    ],
+                    axis=-1,
+                )
+            )
+    candidates = np.stack(candidates)  # [4, N, 3]
+    clipped = _clip_to_limits(candidates)
+    residual = _residuals(points, clipped)
+    clipping = np.abs(clipped - candidates).sum(axis=-1)
+    # Lowest residual first, amount of clipping breaks ties
+    best = np.lexsort((clipping, np.round(residual, 9)), axis=0)[0]
+    rows = np.arange(len(points))
+    return clipped[best, rows], residual[best, rows]
+
+
+def forward_kinematics_batch(thetas, degrees=False):
+    """End effector positions [N, 3] for joint angles thetas [N, 3].
+
+    Angles are in radians like forward_kinematics unless degrees is set.
+    """
+    thetas = np.asarray(thetas, dtype=float)
+    if degrees:
+        thetas = np.deg2rad(thetas)
+    return np.stack(
+        _forward_kinematics(thetas[..., 0], thetas[..., 1], thetas[..., 2]), axis=-1
+    )
+
+
+def inverse_kinematics_batch(points, refine=True, tolerance=1e-3):
+    """Analytic inverse kinematics for points [N, 3] in one vectorized pass.
+
+    Returns joint angles [N, 3] in degrees and a reachable mask [N], a point
+    is reachable if the residual distance is below tolerance (meters). With
+    refine, unreachable points get the closest of the analytic and the
+    hierarchical_inverse_kinematics solution.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    angles, residual = _analytic_batch(points)
+    if refine:
+        todo = residual >= 1e-6
+        if todo.any():
+            angles[todo], residual[todo] = _refine_batch(points[todo], angles[todo])
+        # For targets out of reach, clipping every joint on its own can end
+        # up on the wrong side of the workspace, search those on a grid
+        for i in np.flatnonzero(residual >= tolerance):
+            retry, retry_residual = hierarchical_inverse_kinematics(*points[i])
+            if retry_residual < residual[i]:
+                angles[i], residual[i] = retry, retry_residual
+    return angles, residual < tolerance
+
+
+def refine_inverse_kinematics(x, y, z, angles, iterations=10, tolerance=1e-6):
+    """Damped Gauss-Newton refinement of angles (degrees) towards (x, y, z).
+
+    Angles are clipped to the joint limits after every step, so for targets
+    outside the workspace this ends up close to the nearest reachable point.
+    """
+    angles, residual = _refine_batch(
+        np.array([[x, y, z]], dtype=float),
+        np.array([angles], dtype=float),
+        iterations=iterations,
+        tolerance=tolerance,
+    )
+    return tuple(float(a) for a in angles[0]), float(residual[0])
+
+
+def analytic_inverse_kinematics(x, y, z, refine=True, tolerance=1e-3):
+    """Closed form inverse kinematics, angles in degrees.
+
+    Returns the angles and whether the target is reachable within the joint
+    limits (residual distance below tolerance, in meters).
+    """
+    angles, reachable = inverse_kinematics_batch(
+        [x, y, z], refine=refine, tolerance=tolerance
+    )
+    return tuple(float(a) for a in angles[0]), bool(reachable[0])
+
+
+# Rough bytes of temporaries per evaluated grid point in _forward_kinematics
+_BYTES_PER_GRID_POINT = 16 * 8
+
+
+def _search_grid(target, ranges, keep, max_points):
+    # Evaluate the forward kinematics on the grid spanned by ranges (radians)
+    # in theta0 chunks of at most max_points, returns the keep best angle
+    # triples and their distances to target.
+    theta0_range, theta1_range, theta2_range = ranges
+    theta1_grid, theta2_grid = np.meshgrid(theta1_range, theta2_range, indexing="ij")
+    chunk = max(1, max_points // theta1_grid.size)
+    best_angles = np.empty((0, 3))
+    best_dist = np.empty(0)
+    for start in range(0, len(theta0_range), chunk):
+        theta0 = theta0_range[start : start + chunk, None, None]
+        x0, y0, z0 = _forward_kinematics(theta0, theta1_grid, theta2_grid)
+        dist = np.sqrt(
+            (x0 - target[0]) ** 2 + (y0 - target[1]) ** 2 + (z0 - target[2]) ** 2
+        ).ravel()
+        n = min(keep, dist.size)
+        index = np.argpartition(dist, n - 1)[:n]
+        i, j, k = np.unravel_index(index, (len(theta0), *theta1_grid.shape))
+        angles = np.column_stack([theta0[i, 0, 0], theta1_range[j], theta2_range[k]])
+        best_angles = np.concatenate([best_angles, angles])
+        best_dist = np.concatenate([best_dist, dist[index]])
+        order = np.argsort(best_dist)[:keep]
+        best_angles, best_dist = best_angles[order], best_dist[order]
+    return best_angles, best_dist
+
+
+def hierarchical_inverse_kinematics(
+    x,
+    y,
+    z,
+    coarse_step=5.0,
+    min_step=0.1,
+    refine_factor=5,
+    beam=4,
+    tolerance=1e-4,
+    memory_budget=4 * 2**20,
+):
+    """Coarse to fine grid search inverse kinematics, angles in degrees.
+
+    Starts with a coarse_step grid over the joint limits, then repeatedly
+    searches a finer grid (refine_factor times smaller step) around the beam
+    best cells until the step is below min_step or the residual is below
+    tolerance (meters). Temporaries are kept under memory_budget bytes.
+    Returns the angles and the residual distance.
+    """
+    target = np.array([x, y, z], dtype=float)
+    lower, upper = _LOWER_LIMITS, _UPPER_LIMITS
+    max_points = max(1, memory_budget // _BYTES_PER_GRID_POINT)
+
+    ranges = [
+        np.deg2rad(np.linspace(lo, hi, int(np.ceil((hi - lo) / coarse_step)) + 1))
+        for lo, hi in zip(lower, upper)
+    ]
+    angles, dist = _search_grid(target, ranges, beam, max_points)
+    step = coarse_step
+
+    while step > min_step and dist[0] > tolerance:
+        fine_step = max(step / refine_factor, min_step)
+        offsets = np.arange(-step, step + fine_step / 2, fine_step)
+        candidates = [(angles[0], dist[0])]
+        for center in np.rad2deg(angles):
+            ranges = [
+                np.deg2rad(np.unique(np.clip(c + offsets, lo, hi)))
+                for c, lo, hi in zip(center, lower, upper)
+            ]
+            cell_angles, cell_dist = _search_grid(target, ranges, beam, max_points)
+            candidates.extend(zip(cell_angles, cell_dist))
+        candidates.sort(key=lambda candidate: candidate[1])
+        angles = np.array([a for a, _ in candidates[:beam]])
+        dist = np.array([d for _, d in candidates[:beam]])
+        step = fine_step
+
+    return tuple(float(a) for a in np.rad2deg(angles[0])), float(dist[0])
+
 
 def dumb_but_optimized_inverse_kinematics(x, y, z):
     # Define angle ranges
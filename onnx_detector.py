@@ -0,0 +1,154 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+
+def export_onnx(weights, imgsz=640, quantize=False) -> Path:
+    """Export Ultralytics weights to ONNX next to the .pt file.
+
+    With quantize the weights are additionally quantized to INT8
+    (dynamic quantization) and the path of the quantized model is returned.
+    """
+    from ultralytics import YOLO
+
+    path = Path(YOLO(weights).export(format="onnx", imgsz=imgsz, dynamic=True))
+    if not quantize:
+        return path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized = path.with_name(path.stem + "_int8.onnx")
+    quantize_dynamic(path, quantized, weight_type=QuantType.QInt8)
+    return quantized
+
+
+def letterbox(frame, size=640, color=(114, 114, 114)):
+    """Resize keeping the aspect ratio and pad to size x size.
+
+    Returns the padded image, the scale and the (x, y) padding.
+    """
+    height, width = frame.shape[:2]
+    ratio = min(size / height, size / width)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    pad_x = (size - new_width) // 2
+    pad_y = (size - new_height) // 2
+    image = np.full((size, size, 3), color, dtype=np.uint8)
+    image[pad_y : pad_y + new_height, pad_x : pad_x + new_width] = cv2.resize(
+        frame, (new_width, new_height), interpolation=cv2.INTER_LINEAR
+    )
+    return image, ratio, (pad_x, pad_y)
+
+
+def nms(boxes, scores, iou_threshold):
+    """Greedy non maximum suppression, boxes [N, 4] as x1, y1, x2, y2.
+
+    Returns the indices of the kept boxes, highest score first.
+    """
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-scores)
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        h = np.maximum(0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        intersection = w * h
+        iou = intersection / (areas[i] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+class OnnxBox:
+    # Same indexing as an Ultralytics box: xyxy[0], conf[0], cls[0]
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = xyxy[None, :]
+        self.conf = np.array([conf])
+        self.cls = np.array([cls])
+
+
+class OnnxResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class OnnxDetector:
+    """YOLO detector running an exported ONNX model on ONNX Runtime.
+
+    Called like an Ultralytics YOLO model with one frame or a list of frames
+    and returns results whose boxes can be read the same way, so Camera can
+    use either one.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        conf_threshold=0.25,
+        iou_threshold=0.45,
+        max_detections=300,
+        threads=0,
+    ):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            str(model_path), options, providers=["CPUExecutionProvider"]
+        )
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        size = model_input.shape[2]
+        self.input_size = size if isinstance(size, int) else 640
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+
+    def __call__(self, frames, stream=False, **kwargs):
+        if not isinstance(frames, (list, tuple)):
+            frames = [frames]
+        letterboxed = [letterbox(frame, self.input_size) for frame in frames]
+        # BGR HWC uint8 -> RGB NCHW float in [0, 1]
+        batch = np.stack([image for image, _, _ in letterboxed])
+        batch = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2))
+        batch = batch.astype(np.float32) / 255.0
+
+        if self.dynamic_batch:
+            outputs = self.session.run(None, {self.input_name: batch})[0]
+        else:
+            outputs = np.concatenate(
+                [
+                    self.session.run(None, {self.input_name: image[None]})[0]
+                    for image in batch
+                ]
+            )
+
+        results = [
+            self._postprocess(output, ratio, pad, frame.shape[:2])
+            for output, (_, ratio, pad), frame in zip(outputs, letterboxed, frames)
+        ]
+        return iter(results) if stream else results
+
+    def _postprocess(self, output, ratio, pad, shape):
+        # output is [4 + classes, anchors]: cx, cy, w, h, class scores
+        predictions = output.T
+        class_scores = predictions[:, 4:]
+        classes = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(classes)), classes]
+        mask = scores > self.conf_threshold
+        predictions, classes, scores = predictions[mask], classes[mask], scores[mask]
+
+        cx, cy, w, h = predictions[:, :4].T
+        boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+        # Undo the letterbox
+        boxes -= (pad[0], pad[1], pad[0], pad[1])
+        boxes /= ratio
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, shape[1])
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, shape[0])
+
+        # Class aware NMS by moving every class to its own region
+        offsets = classes[:, None] * (max(shape) + 1)
+        keep = nms(boxes + offsets, scores, self.iou_threshold)[: self.max_detections]
+        return OnnxResult([OnnxBox(boxes[i], scores[i], classes[i]) for i in keep])
@@ -19,9 +19,11 @@ class ControlPanel(tk.Tk):
         self.buttons = []
         self.servo_frame = ttk.Frame(self)
         self.servo_frame.pack(side=tk.LEFT, padx=10, pady=5)
+        # The detector, the workspace lookup and the serial connection are
+        # loaded in the background, the buttons are enabled once they are ready
         self.camera = Camera(index=CAMERA_INDEX)
         if hubert is None:
-            self.hubert = Hubert(mock=USE_MOCK_ARUDINO)
+            self.hubert = Hubert(mock=USE_MOCK_ARUDINO, connect_in_background=True)
         else:
             self.hubert = hubert
 
@@ -30,7 +32,8 @@ class ControlPanel(tk.Tk):
         self.create_info_panel()
         self.create_video_feed()
         self.update_info_panel()
-        self.enable_buttons()
+        self.disable_buttons()
+        self.update_status()
         self.update_video_feed()
 
     def create_servo_controls(self):
@@ -99,6 +102,18 @@ class ControlPanel(tk.Tk):
             label.grid(row=9 + i, column=1)
             self.current_servo_labels.append(label)
 
+        # Startup status
+        row = 9 + len(self.hubert._arduino.servos)
+        ttk.Label(self.info_frame, text="Status:").grid(row=row, column=0, columnspan=2)
+        self.status_labels = {}
+        for i, name in enumerate(["detector"] + list(self.hubert.readiness())):
+            ttk.Label(self.info_frame, text=f"{name.capitalize()}:").grid(
+                row=row + 1 + i, column=0
+            )
+            label = ttk.Label(self.info_frame, text="loading")
+            label.grid(row=row + 1 + i, column=1)
+            self.status_labels[name] = label
+
     def create_controls(self):
         controls_frame = ttk.Frame(self)
         controls_frame.pack(padx=10, pady=10)
@@ -184,6 +199,15 @@ class ControlPanel(tk.Tk):
         self.canvas = tk.Canvas(self.video_frame, width=640, height=480)
         self.canvas.pack()
 
+    def update_status(self):
+        status = {"detector": self.camera.status, **self.hubert.readiness()}
+        for name, label in self.status_labels.items():
+            label.config(text=status[name])
+        if self.camera.is_ready() and self.hubert.is_ready():
+            self.enable_buttons()
+        else:
+            self.after(200, self.update_status)
+
     def update_video_feed(self):
         try:
             frame = self.camera.grab_frame()
@@ -270,6 +294,7 @@ class ControlPanel(tk.Tk):
         # self.hubert.sort_order = [["cylinder"], ["red", "green"]]
         sorted_objects = self.hubert.get_sorted_objects(camera_detections)
         print(sorted_objects)
+        pick_angles, drop_off_angles = self.hubert.plan_sort(sorted_objects)
         for position, objects in enumerate(sorted_objects):
             for idx, obj in enumerate(objects):
                 print(
@@ -280,15 +305,21 @@ class ControlPanel(tk.Tk):
                 )
                 self.hubert.say(f"Picking up a {obj.color} {obj.shape}.")
                 self.hubert.action_pick_up(
-                    obj.global_x, obj.global_y, obj.global_z + 0.02
+                    obj.global_x,
+                    obj.global_y,
+                    obj.global_z + 0.02,
+                    angles=pick_angles[position][idx],
                 )
                 self.hubert.say(f"Moving to drop off position {position}.")
-                self.hubert.action_drop_off(idx=idx, position=position)
+                self.hubert.action_drop_off(
+                    idx=idx, position=position, angles=drop_off_angles[idx]
+                )
         # height = 0.04
         print("Done")
+        self.hubert.save_ik_cache()
         self.hubert.angles = [0, 90, -90]
         self.hubert._arduino.servos[self.hubert._arduino.CAMERA_TILT].position = 2100
-        self.hubert._arduino.send_to_arduino()
+        self.hubert._arduino.send_async()
         self.hubert.say("I AM DONE")
         self.update_info_panel()
 
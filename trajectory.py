@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+
+
+def trapezoidal_duration(distance, max_velocity, max_acceleration):
+    # Triangular profile if max_velocity is never reached
+    if distance < max_velocity**2 / max_acceleration:
+        return 2 * np.sqrt(distance / max_acceleration)
+    return distance / max_velocity + max_velocity / max_acceleration
+
+
+def trapezoidal_profile(t, duration, distance, max_acceleration):
+    """Normalized position (0 to 1) at times t of a trapezoidal velocity
+    profile covering distance in duration."""
+    t = np.clip(t, 0, duration)
+    # Time spent accelerating, from distance = a * ta * (duration - ta)
+    ta = duration / 2 - np.sqrt(max(duration**2 / 4 - distance / max_acceleration, 0.0))
+    velocity = max_acceleration * ta
+    s = np.where(
+        t < ta,
+        0.5 * max_acceleration * t**2,
+        np.where(
+            t <= duration - ta,
+            0.5 * max_acceleration * ta**2 + velocity * (t - ta),
+            distance - 0.5 * max_acceleration * (duration - t) ** 2,
+        ),
+    )
+    return s / distance
+
+
+def cubic_profile(t, duration):
+    """Normalized position (0 to 1) at times t of a cubic with zero start and
+    end velocity."""
+    tau = np.clip(t / duration, 0, 1)
+    return 3 * tau**2 - 2 * tau**3
+
+
+def plan_trajectory(
+    start,
+    goal,
+    max_velocity=30.0,
+    max_acceleration=60.0,
+    rate=20.0,
+    profile="trapezoidal",
+):
+    """Time parameterized joint waypoints from start to goal.
+
+    Angles in degrees, velocity and acceleration limits in degrees per
+    second (squared) and apply to the joint that moves the furthest, the
+    others are scaled so all joints arrive together. Returns waypoint times
+    [M] in seconds and angles [M, 3], sampled at rate Hz and always ending
+    exactly at goal.
+    """
+    start = np.asarray(start, dtype=float)
+    goal = np.asarray(goal, dtype=float)
+    delta = goal - start
+    distance = np.abs(delta).max()
+    if distance == 0:
+        return np.zeros(1), goal[None, :]
+
+    if profile == "trapezoidal":
+        duration = trapezoidal_duration(distance, max_velocity, max_acceleration)
+    elif profile == "cubic":
+        # Peak velocity of the cubic is 1.5 * distance / duration
+        duration = max(
+            1.5 * distance / max_velocity, np.sqrt(6 * distance / max_acceleration)
+        )
+    else:
+        raise ValueError(f"Unknown trajectory profile: {profile}")
+
+    times = np.arange(1, int(np.ceil(duration * rate)) + 1) / rate
+    times[-1] = duration
+    if profile == "trapezoidal":
+        s = trapezoidal_profile(times, duration, distance, max_acceleration)
+    else:
+        s = cubic_profile(times, duration)
+    return times, start + s[:, None] * delta
+
+
+def stream_trajectory(arduino, times, angles, timeout=None):
+    """Send the waypoints to the Arduino at their scheduled times.
+
+    Commands are queued on the serial I/O thread, so this only sleeps until
+    the next waypoint is due. Returns the reply to the last waypoint as soon
+    as it arrives.
+    """
+    start = time.monotonic()
+    future = None
+    for t, waypoint in zip(times, angles):
+        delay = start + t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        arduino.set_angles(waypoint)
+        future = arduino.send_async()
+    return future.result(timeout) if future is not None else True
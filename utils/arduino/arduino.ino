@@ -255,7 +255,8 @@ void setup() {
   Serial.begin(57600); // Starts the serial communication
   init_robot_positions();
   delay(1000);
-  Serial.println("<Arduino is ready>");
+  // "binary" tells the PC that binary servo frames are understood
+  Serial.println("<Arduino is ready,binary>");
 
 
 	//Attach each joint servo
@@ -267,7 +268,14 @@ void setup() {
 const byte numChars = 40;
 char receivedChars[numChars];
 
+// Binary frame: 0xA5, servo bitmask, uint16 little endian position for each
+// servo in the mask, CRC-8 over mask and positions.
+const byte binStartMarker = 0xA5;
+byte binBuffer[1 + 2 * 6 + 1];
+byte binLength = 0;
+
 bool newData = false;
+bool binaryData = false;
 
 
 void loop() {
@@ -279,9 +287,19 @@ void loop() {
 
 
 
-  recvWithStartEndMarkers(&newData);
+  recvWithStartEndMarkers(&newData, &binaryData);
   if (newData == true) {
-    parseCommand(receivedChars, new_positions, 6);
+    if (binaryData == true) {
+      if (!parseBinaryCommand(binBuffer, binLength, new_positions)) {
+        Serial.println("<ERR CRC>");
+        newData = false;
+        binaryData = false;
+        return;
+      }
+    }
+    else {
+      parseCommand(receivedChars, new_positions, 6);
+    }
     servo_body_ex(new_positions[0]);
     servo_neck_pan(new_positions[1]);
     servo_neck_tilt(new_positions[2]);
@@ -289,23 +307,47 @@ void loop() {
     // servo_elbow(new_positions[4]);
     // servo_shoulder(new_positions[3]);
     servo_gripper_ex(new_positions[5]);
-    showNewData();
+    if (binaryData == true) {
+      Serial.println("<OK>");
+    }
+    else {
+      showNewData();
+    }
     newData = false;
+    binaryData = false;
   }
 }
 
 
 
-void recvWithStartEndMarkers(bool *newData) {
+void recvWithStartEndMarkers(bool *newData, bool *binaryData) {
     static boolean recvInProgress = false;
     static byte ndx = 0;
+    static byte binNdx = 0;
+    static byte binExpected = 0;
     char startMarker = '<';
     char endMarker = '>';
     char rc;
     while (Serial.available() > 0 && *newData == false) {
         rc = Serial.read();
 
-        if (recvInProgress == true) {
+        if (binExpected > 0) {
+            binBuffer[binNdx] = rc;
+            binNdx++;
+            if (binNdx == 1) {
+                // mask byte, followed by two bytes per servo and the CRC
+                binExpected = 1 + 2 * countServos(rc) + 1;
+            }
+            if (binNdx >= binExpected) {
+                binLength = binNdx;
+                binNdx = 0;
+                binExpected = 0;
+                *newData = true;
+                *binaryData = true;
+            }
+        }
+
+        else if (recvInProgress == true) {
             if (rc != endMarker) {
                 receivedChars[ndx] = rc;
                 ndx++;
@@ -324,7 +366,49 @@ void recvWithStartEndMarkers(bool *newData) {
         else if (rc == startMarker) {
             recvInProgress = true;
         }
+
+        else if ((byte)rc == binStartMarker) {
+            binNdx = 0;
+            binExpected = 1;
+        }
+    }
+}
+
+byte countServos(byte mask) {
+    byte count = 0;
+    for (int i = 0; i < 6; i++) {
+        if (mask & (1 << i)) {
+            count++;
+        }
+    }
+    return count;
+}
+
+byte crc8(const byte *data, byte length) {
+    // CRC-8, poly x^8 + x^2 + x + 1, init 0. Same as crc8() on the PC side.
+    byte crc = 0;
+    for (byte i = 0; i < length; i++) {
+        crc ^= data[i];
+        for (byte bit = 0; bit < 8; bit++) {
+            crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+        }
+    }
+    return crc;
+}
+
+bool parseBinaryCommand(const byte *frame, byte length, int* new_positions) {
+    if (crc8(frame, length - 1) != frame[length - 1]) {
+        return false;
+    }
+    byte mask = frame[0];
+    byte idx = 1;
+    for (int i = 0; i < 6; i++) {
+        if (mask & (1 << i)) {
+            new_positions[i] = frame[idx] | (frame[idx + 1] << 8);
+            idx += 2;
+        }
     }
+    return true;
 }
 void parseCommand(char* command, int* new_positions, int numValues) {
     char *ptr = strtok(command, ",");
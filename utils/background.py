@@ -0,0 +1,57 @@
+import threading
+
+
+class BackgroundLoader:
+    """Builds a value with load() in a daemon thread.
+
+    With start=False nothing happens until the first get(), so the value is
+    loaded on first use. get() blocks until the value is available and
+    re-raises any error from load().
+    """
+
+    def __init__(self, name, load, start=True):
+        self.name = name
+        self._load = load
+        self._value = None
+        self._error = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if start:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name=self.name, daemon=True).start()
+
+    def _run(self):
+        try:
+            self._value = self._load()
+        except Exception as e:
+            print(f"Error loading {self.name}: {e}")
+            self._error = e
+        finally:
+            self._done.set()
+
+    @property
+    def ready(self):
+        return self._done.is_set() and self._error is None
+
+    @property
+    def status(self):
+        if not self._started:
+            return "not loaded"
+        if not self._done.is_set():
+            return "loading"
+        return "failed" if self._error is not None else "ready"
+
+    def get(self, timeout=None):
+        self.start()
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.name} is still loading")
+        if self._error is not None:
+            raise self._error
+        return self._value
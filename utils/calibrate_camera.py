@@ -0,0 +1,143 @@
+"""Calibrate the camera from saved checkerboard images.
+
+Record a video with utils/record_video.py while moving a checkerboard in
+front of the camera and split it with utils/extract_frames.py. Then take
+one more picture with the camera pan at 0 degrees and the board lying flat
+on the table, and measure where its first inner corner is in robot
+coordinates (x forward, y left, meters). Run from the repository root:
+
+    python -m utils.calibrate_camera frames/ --table-image table.jpg \
+        --board 9 6 --square 0.025 --board-origin 0.2 0.05
+
+The first board axis (along a row of corners) points at --board-angle
+degrees from x, use --flip if the second axis points right instead of
+left. Writes the intrinsics, distortion and the table homography to
+camera_calibration.json, which Camera loads on startup.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+
+import cv2
+import numpy as np
+
+from camera_model import CALIBRATION_PATH, save_calibration
+
+_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+
+def find_corners(image, board):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    found, corners = cv2.findChessboardCorners(
+        gray,
+        board,
+        flags=cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE,
+    )
+    if not found:
+        return None
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), _CRITERIA)
+
+
+def board_points(board, square):
+    # Corner (column, row) at (column * square, row * square) on the board
+    columns, rows = board
+    grid = np.mgrid[0:columns, 0:rows].T.reshape(-1, 2)
+    return grid.astype(np.float32) * square
+
+
+def calibrate(paths, board, square):
+    object_points, image_points = [], []
+    size = None
+    for path in paths:
+        image = cv2.imread(str(path))
+        if image is None:
+            continue
+        size = image.shape[1::-1]
+        corners = find_corners(image, board)
+        if corners is None:
+            print(f"{path.name}: board not found")
+            continue
+        points = np.zeros((board[0] * board[1], 3), np.float32)
+        points[:, :2] = board_points(board, square)
+        object_points.append(points)
+        image_points.append(corners)
+    if len(image_points) < 3:
+        raise ValueError(f"Board found in {len(image_points)} images, need 3")
+    rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(
+        object_points, image_points, size, None, None
+    )
+    print(f"Calibrated from {len(image_points)} images, RMS error {rms:.3f} px")
+    return camera_matrix, dist_coeffs, size, rms
+
+
+def table_homography(
+    image, board, square, camera_matrix, dist_coeffs, origin, angle, flip
+):
+    """Homography from undistorted pixels to (x, y) on the table."""
+    corners = find_corners(image, board)
+    if corners is None:
+        raise ValueError("Board not found in the table image")
+    pixels = cv2.undistortPoints(
+        corners, camera_matrix, dist_coeffs, P=camera_matrix
+    ).reshape(-1, 2)
+
+    theta = np.deg2rad(angle)
+    u_axis = np.array([np.cos(theta), np.sin(theta)])
+    v_axis = np.array([-np.sin(theta), np.cos(theta)]) * (-1 if flip else 1)
+    local = board_points(board, square)
+    table = origin + local[:, :1] * u_axis + local[:, 1:] * v_axis
+
+    homography, _ = cv2.findHomography(pixels, table)
+    mapped = cv2.perspectiveTransform(pixels.reshape(-1, 1, 2), homography)
+    error = np.linalg.norm(mapped.reshape(-1, 2) - table, axis=1)
+    print(f"Table mapping error: mean {1000 * error.mean():.1f} mm")
+    return homography
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("frames", help="Folder with checkerboard images")
+    parser.add_argument("--table-image", required=True)
+    parser.add_argument("--board", type=int, nargs=2, default=(9, 6))
+    parser.add_argument("--square", type=float, default=0.025)
+    parser.add_argument("--board-origin", type=float, nargs=2, required=True)
+    parser.add_argument("--board-angle", type=float, default=0.0)
+    parser.add_argument("--flip", action="store_true")
+    parser.add_argument("--output", default=str(CALIBRATION_PATH))
+    args = parser.parse_args()
+
+    board = tuple(args.board)
+    paths = sorted(
+        path
+        for path in Path(args.frames).iterdir()
+        if path.suffix.lower() in (".jpg", ".jpeg", ".png")
+    )
+    camera_matrix, dist_coeffs, size, rms = calibrate(paths, board, args.square)
+
+    table_image = cv2.imread(args.table_image)
+    if table_image is None:
+        print(f"Could not read {args.table_image}")
+        return 1
+    if table_image.shape[1::-1] != size:
+        print("Table image has a different resolution than the frames")
+        return 1
+    homography = table_homography(
+        table_image,
+        board,
+        args.square,
+        camera_matrix,
+        dist_coeffs,
+        np.array(args.board_origin),
+        args.board_angle,
+        args.flip,
+    )
+    path = save_calibration(
+        camera_matrix, dist_coeffs, homography, size, rms, args.output
+    )
+    print(f"Saved calibration to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
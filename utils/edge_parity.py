@@ -0,0 +1,89 @@
+"""Compare the OpenCV edge detector of vision.py with the former scipy +
+skimage one on saved frames.
+
+Run from the repository root (needs scipy and scikit-image):
+
+    python -m utils.edge_parity
+
+Exits with 1 if any frame gives different edges or shapes.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from vision import classify_shape, detect_edges
+
+
+def reference_edges(gray):
+    # The edge detection get_detected_objects used before
+    from scipy import ndimage as ndi
+    from skimage import feature
+
+    edges = feature.canny(ndi.gaussian_filter(gray, 4), sigma=3.5)
+    return (edges * 255).astype(np.uint8)
+
+
+def detected_shapes(edges, min_area=2000):
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    shapes = []
+    for contour in contours:
+        if cv2.contourArea(contour) > min_area:
+            x, y, w, h = cv2.boundingRect(contour)
+            shapes.append((classify_shape(contour), x, y, w, h))
+    return sorted(shapes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--frames", default=str(Path("neural_network") / "frames_output")
+    )
+    parser.add_argument("--step", type=int, default=1, help="Use every n-th frame")
+    args = parser.parse_args()
+
+    paths = sorted(Path(args.frames).glob("*.jpg"))[:: args.step]
+    if not paths:
+        print(f"No frames found in {args.frames}")
+        return 1
+
+    shape_count = different_frames = different_pixels = 0
+    reference_time = new_time = 0.0
+    for path in paths:
+        gray = cv2.cvtColor(cv2.imread(str(path)), cv2.COLOR_BGR2GRAY)
+        start = time.perf_counter()
+        expected_edges = reference_edges(gray)
+        reference_time += time.perf_counter() - start
+        start = time.perf_counter()
+        edges = detect_edges(gray)
+        new_time += time.perf_counter() - start
+
+        expected = detected_shapes(expected_edges)
+        found = detected_shapes(edges)
+        pixels = np.count_nonzero(expected_edges != edges)
+        shape_count += len(expected)
+        different_pixels += pixels
+        if found != expected or pixels:
+            different_frames += 1
+            print(
+                f"{path.name}: {pixels} edge pixels differ, "
+                f"expected {expected}, found {found}"
+            )
+
+    print(
+        f"{len(paths)} frames, {shape_count} shapes, {different_frames} frames "
+        f"differ, {different_pixels} edge pixels differ"
+    )
+    print(
+        f"Per frame: reference {1000 * reference_time / len(paths):.1f} ms, "
+        f"opencv {1000 * new_time / len(paths):.1f} ms"
+    )
+    return 1 if different_frames else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
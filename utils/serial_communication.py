@@ -1,5 +1,9 @@
+from collections import deque
+from concurrent.futures import Future
 from dataclasses import dataclass
 import os
+import queue
+import threading
 from typing import List
 import numpy as np
 import serial
@@ -31,6 +35,8 @@ class Servo:
         self.offset = offset
         self._inversed = inversed
         self._angle = angle
+        # Set when the position changed since it was last sent
+        self.dirty = True
 
     @property
     def angle(self):
@@ -75,28 +81,129 @@ class Servo:
 
         if value < self.min:
             print("Warn: Value less than min - ", self.name)
-            self._position = self.min + self.offset
+            self._set_position(self.min + self.offset)
         elif value > self.max:
             print("Warn: Value greater than max - ", self.name)
-            self._position = self.max + self.offset
+            self._set_position(self.max + self.offset)
         else:
-            self._position = int(value) + self.offset
+            self._set_position(int(value) + self.offset)
+
+    def _set_position(self, value):
+        if value != self._position:
+            self.dirty = True
+        self._position = value
 
     def increment_position(self, amount):
         new_value = self._position + amount
         if new_value < self.min:
             print("Warn: Value less than min - ", self.name)
-            self._position = self.min
+            self._set_position(self.min)
         elif new_value > self.max:
             print("Warn: Value greater than max - ", self.name)
-            self._position = self.max
-        self._position = new_value
+            self._set_position(self.max)
+        self._set_position(new_value)
+
+
+BINARY_START = 0xA5
+BINARY_HANDSHAKE = "binary"
+# The firmware steps every servo to its target (6 us per 20 ms) and waits
+# about 90 ms in fixed delays before acknowledging a command. Initial guess
+# of that time in seconds, refined from the measured replies.
+FIRMWARE_COMMAND_TIME = 0.15
+
+
+def crc8(data, poly=0x07):
+    # CRC-8 (poly x^8 + x^2 + x + 1, init 0), same as crc8() in arduino.ino
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def encode_binary_frame(positions, changed=None) -> bytes:
+    """Binary servo command: start byte, servo bitmask, little endian uint16
+    positions for the servos in the mask, CRC-8 over mask and positions.
+
+    Only servos flagged in changed are included, all of them when changed
+    is None.
+    """
+    mask = 0
+    payload = bytearray()
+    for i, position in enumerate(positions):
+        if changed is None or changed[i]:
+            mask |= 1 << i
+            payload += int(position).to_bytes(2, "little")
+    body = bytes([mask]) + payload
+    return bytes([BINARY_START]) + body + bytes([crc8(body)])
+
+
+class FrameDecoder:
+    """Incremental decoder for <...> framed replies.
+
+    Bytes are fed in whatever chunks the port returns, complete frames are
+    returned without markers. Broken frames (a new start marker before the
+    end marker, or longer than max_length) are dropped and kept in
+    malformed. Bytes between frames, like the newline after each reply, are
+    ignored.
+    """
+
+    def __init__(self, start_marker=b"<", end_marker=b">", max_length=64):
+        self.start_marker = start_marker
+        self.end_marker = end_marker
+        self.max_length = max_length
+        self.malformed: List[bytes] = []
+        self._buffer = bytearray()
+
+    def feed(self, data) -> List[bytes]:
+        self._buffer += data
+        frames = []
+        while True:
+            start = self._buffer.find(self.start_marker)
+            if start == -1:
+                self._buffer.clear()
+                break
+            end = self._buffer.find(self.end_marker, start + 1)
+            restart = self._buffer.find(self.start_marker, start + 1)
+            if restart != -1 and (end == -1 or restart < end):
+                self.malformed.append(bytes(self._buffer[start:restart]))
+                del self._buffer[:restart]
+                continue
+            if end == -1:
+                del self._buffer[:start]
+                if len(self._buffer) > self.max_length:
+                    self.malformed.append(bytes(self._buffer))
+                    self._buffer.clear()
+                break
+            frames.append(bytes(self._buffer[start + 1 : end]))
+            del self._buffer[: end + 1]
+        return frames
+
+    def reset(self):
+        self._buffer.clear()
 
 
 class ArduinoSerial:
-    def __init__(self, port: str = "COM7", baud: int = 57600, mock=False) -> None:
+    def __init__(
+        self,
+        port: str = "COM7",
+        baud: int = 57600,
+        mock=False,
+        queue_size: int = 16,
+        reply_timeout: float = 30.0,
+        binary: bool = True,
+        connect_in_background: bool = False,
+    ) -> None:
         self.serPort = port
         self.baud = baud
+        self.reply_timeout = reply_timeout
+        # Running average of the time from sending a command to its reply
+        self.command_time = FIRMWARE_COMMAND_TIME
+        # Binary framing is used if requested and the firmware announces it
+        # in the ready message, otherwise the ASCII <pos,pos,...> format
+        self.binary = binary
+        self.protocol = "ascii"
         self.BODY = 0
         self.CAMERA_PAN = 1
         self.CAMERA_TILT = 2
@@ -165,24 +272,55 @@ class ArduinoSerial:
         self.ser = None
         self.start_marker = 60  # ASCII '<'
         self.end_marker = 62  # ASCII '>'
-        self.connect()
-        self.wait_for_arduino()
-        self.send_to_arduino(wait_for_reply=True)
+        # Commands are written by a dedicated I/O thread, in order. Each
+        # entry is (positions, changed, wait_for_reply, timeout, future) and
+        # is encoded when sent, None stops the thread.
+        self._commands = queue.Queue(maxsize=queue_size)
+        self._last_command = None
+        self._decoder = FrameDecoder(
+            bytes([self.start_marker]), bytes([self.end_marker])
+        )
+        self._frames = deque()
+        # Set once the Arduino has announced itself, commands queued before
+        # that are sent afterwards
+        self.ready = threading.Event()
+        self._connect_error = None
+        if not connect_in_background:
+            self.connect()
+            self.wait_for_arduino()
+            self.ready.set()
+        self._io_thread = threading.Thread(target=self._io_loop, daemon=True)
+        self._io_thread.start()
+        if connect_in_background:
+            self.send_async()
+        else:
+            self.send_to_arduino(wait_for_reply=True)
+
+    def is_ready(self):
+        return self.ready.is_set() and self._connect_error is None
+
+    @property
+    def status(self):
+        if not self.ready.is_set():
+            return "connecting"
+        return "failed" if self._connect_error is not None else "ready"
 
     @property
     def gripper_open(self):
         return self._gripper_open
 
-    def open_gripper(self):
+    def open_gripper(self, wait=True):
         self._gripper_open = True
         self.servos[self.GRIPPER].position = 750
-        self.send_to_arduino(wait_for_reply=True)
+        future = self.send_async()
+        return future.result() if wait else future
 
-    def close_gripper(self):
+    def close_gripper(self, wait=True):
         self._gripper_open = False
         # self.servos[self.GRIPPER].position = 2050
         self.servos[self.GRIPPER].position = 1350
-        self.send_to_arduino(wait_for_reply=True)
+        future = self.send_async()
+        return future.result() if wait else future
 
     def connect(self):
 
@@ -190,17 +328,22 @@ class ArduinoSerial:
             self.serPort = "COM7"
 
         if not self.mock:
+            # Reads block in the driver for at most this long, so waiting for
+            # a reply never spins
             try:
-                self.ser = serial.Serial(self.serPort, self.baud)
+                self.ser = serial.Serial(self.serPort, self.baud, timeout=0.1)
             except serial.serialutil.SerialException as e:
                 print("Error opening serial port: " + str(e))
                 print("Trying other port...")
                 self.serPort = "/dev/ttyACM1" if os.name == "posix" else "COM4"
-                self.ser = serial.Serial(self.serPort, self.baud)
+                self.ser = serial.Serial(self.serPort, self.baud, timeout=0.1)
 
         print("Serial port " + self.serPort + " opened  Baudrate " + str(self.baud))
 
     def close(self):
+        if self._io_thread.is_alive():
+            self._commands.put(None)
+            self._io_thread.join()
         if self.ser and self.ser.is_open and not self.mock:
             self.ser.close()
             print("Serial port " + self.serPort + " closed")
@@ -211,25 +354,111 @@ class ArduinoSerial:
         self.send_to_arduino(wait_for_reply=True)
 
     def send_to_arduino(self, wait_for_reply=False):
-        send_str = chr(self.start_marker)
-        servo_positions = ",".join([f"{servo.position:04d}" for servo in self.servos])
-        send_str += servo_positions
-        send_str += chr(self.end_marker)
-        # print(f"Sent from PC -- {send_str}")
+        future = self.send_async(wait_for_reply=wait_for_reply)
+        if wait_for_reply:
+            return future.result()
+        return True
+
+    def send_async(self, wait_for_reply=True, timeout=None) -> Future:
+        """Queue the current servo positions for sending.
+
+        The positions are captured now, so servos can be changed again right
+        away. The returned future resolves to the Arduino reply (or True when
+        not waiting for one) and raises TimeoutError if no reply arrives
+        within timeout seconds. Blocks while the command queue is full.
+        If no servo changed since the last command nothing is sent and the
+        future is already done.
+        """
+        future = Future()
+        changed = [servo.dirty for servo in self.servos]
+        if not any(changed):
+            future.set_result(True)
+            return future
+
+        positions = [servo.position for servo in self.servos]
+        for servo in self.servos:
+            servo.dirty = False
+        if timeout is None:
+            timeout = self.reply_timeout
+
+        self._commands.put((positions, changed, wait_for_reply, timeout, future))
+        self._last_command = future
+        return future
+
+    def flush(self, timeout=None):
+        """Wait until every queued command has been sent and acknowledged."""
+        if self._last_command is not None:
+            self._last_command.result(timeout)
+
+    def _encode(self, positions, changed):
+        if self.protocol == "binary":
+            return encode_binary_frame(positions, changed)
+        return (
+            chr(self.start_marker)
+            + ",".join([f"{position:04d}" for position in positions])
+            + chr(self.end_marker)
+        ).encode()
+
+    def _io_loop(self):
+        if not self.ready.is_set():
+            try:
+                self.connect()
+                self.wait_for_arduino()
+            except Exception as e:
+                print("Error connecting to Arduino: " + str(e))
+                self._connect_error = e
+            finally:
+                self.ready.set()
+        while True:
+            command = self._commands.get()
+            if command is None:
+                return
+            positions, changed, wait_for_reply, timeout, future = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self._connect_error is not None:
+                future.set_exception(self._connect_error)
+                continue
+            try:
+                payload = self._encode(positions, changed)
+                start = time.monotonic()
+                reply = self._transfer(payload, wait_for_reply, timeout)
+                if wait_for_reply and not self.mock:
+                    elapsed = time.monotonic() - start
+                    self.command_time += 0.2 * (elapsed - self.command_time)
+                future.set_result(reply)
+            except Exception as e:
+                # The Arduino may not have the positions we think, send all
+                # servos with the next command
+                for servo in self.servos:
+                    servo.dirty = True
+                future.set_exception(e)
+
+    def _transfer(self, payload, wait_for_reply, timeout, retries=1):
+        # print(f"Sent from PC -- {payload}")
         if self.mock:
-            print(f"Emulating serial write - {send_str}")
+            print(f"Emulating serial write - {payload}")
             time.sleep(1)
             return True
         else:
-            self.ser.write(send_str.encode())
-
-        if wait_for_reply:
-            while self.ser.inWaiting() == 0:
-                pass
-
-            dataRecvd = self.recv_from_arduino()
+            # Late replies, e.g. to a command that timed out, must not be
+            # taken as the reply to this one
+            if self._frames:
+                print("Warn: Dropping stale replies - ", list(self._frames))
+                self._frames.clear()
+            self.ser.reset_input_buffer()
+            self._decoder.reset()
+            self.ser.write(payload)
+
+        if wait_for_reply or payload[0] == BINARY_START:
+            dataRecvd = self.recv_from_arduino(timeout=timeout)
             # print("Reply Received  " + dataRecvd)
-            return dataRecvd
+            if dataRecvd == "ERR CRC":
+                if retries <= 0:
+                    raise IOError("CRC error on " + self.serPort)
+                print("Warn: CRC error, resending command")
+                return self._transfer(payload, wait_for_reply, timeout, retries - 1)
+            return dataRecvd if wait_for_reply else True
         else:
             return True
 
@@ -238,36 +467,30 @@ class ArduinoSerial:
         self.servos[self.SHOULDER].angle = angles[1]
         self.servos[self.ELBOW].angle = angles[2]
 
-    def recv_from_arduino(self):
-        ck = ""
-        x = b"z"  # any value that is not an end- or startMarker
-        byteCount = (
-            -1
-        )  # to allow for the fact that the last increment will be one too many
-
-        # wait for the start character
-        while ord(x) != self.start_marker:
-            x = self.ser.read()
-
-        # save data until the end marker is found
-        while ord(x) != self.end_marker:
-            if ord(x) != self.start_marker:
-                ck = ck + x.decode()  # Decode bytes to string
-                byteCount += 1
-            x = self.ser.read()
-
-        return ck
+    def recv_from_arduino(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._frames:
+            # Blocks for at most ser.timeout on the first byte, then takes
+            # everything that is already buffered in one call
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            if data:
+                self._frames.extend(self._decoder.feed(data))
+                while self._decoder.malformed:
+                    print("Warn: Malformed frame - ", self._decoder.malformed.pop(0))
+            elif deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("No reply from Arduino on " + self.serPort)
+        return self._frames.popleft().decode(errors="replace")
 
     def wait_for_arduino(self):
         if self.mock:
             return
         msg = ""
         while msg.find("Arduino is ready") == -1:
-            while self.ser.inWaiting() == 0:
-                pass
-
             msg = self.recv_from_arduino()
             # print(msg)
+        if self.binary and BINARY_HANDSHAKE in msg:
+            self.protocol = "binary"
+        print("Serial protocol: " + self.protocol)
 
 
 if __name__ == "__main__":
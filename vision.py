@@ -1,6 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
-import queue
 import threading
 import time
 from typing import List
@@ -8,9 +7,16 @@ import cvzone
 import cv2
 import math
 import numpy as np
-from scipy import ndimage as ndi
-from skimage import feature
-from ultralytics import YOLO
+
+from camera_model import (
+    CALIBRATION_PATH,
+    HomographyTableModel,
+    LinearTableModel,
+    Undistorter,
+    camera_to_world,
+    load_calibration,
+)
+from utils.background import BackgroundLoader
 
 
 classNames = [
@@ -35,6 +41,201 @@ classNames = [
     "white star",
     "white cylinder",
 ]
+_CLASS_COLORS = np.array([name.split()[0] for name in classNames])
+_CLASS_SHAPES = np.array([name.split()[1] for name in classNames])
+
+# HSV ranges (OpenCV scale, H in 0-180) of the classical color segmentation.
+# Where ranges overlap the first one listed wins, red accepts any saturated
+# hue so it goes last.
+COLOR_RANGES = {
+    "white": ((0, 0, 200), (180, 20, 255)),
+    "blue": ((100, 120, 70), (140, 255, 255)),
+    "green": ((40, 50, 50), (90, 255, 255)),
+    "red": ((0, 90, 80), (180, 255, 255)),
+}
+# Colored (non white) pixels must be at least this bright
+MIN_BRIGHTNESS = 140
+# Flat index of an HSV value in the color lookup table
+_HSV_TO_INDEX = np.array([[256 * 256, 256, 1]], dtype=np.float32)
+
+
+def build_color_lut(color_ranges=COLOR_RANGES, min_brightness=MIN_BRIGHTNESS):
+    """HSV to color label lookup table of shape [180, 256, 256].
+
+    Label 0 is background, label i is the i-th color of color_ranges.
+    """
+    lut = np.zeros((180, 256, 256), dtype=np.uint8)
+    # Fill in reverse so the first matching range ends up on top
+    for label, (color, (lower, upper)) in reversed(
+        list(enumerate(color_ranges.items(), start=1))
+    ):
+        v_min = lower[2] if color == "white" else max(lower[2], min_brightness)
+        lut[lower[0] : upper[0] + 1, lower[1] : upper[1] + 1, v_min : upper[2] + 1] = (
+            label
+        )
+    return lut
+
+
+# Edge detection reproduces the former ndi.gaussian_filter(gray, 4) followed
+# by skimage.feature.canny(sigma=3.5) with OpenCV filters, the shapes found
+# are the same (see utils/edge_parity.py)
+EDGE_PRESMOOTH_SIGMA = 4.0
+EDGE_SIGMA = 3.5
+# Canny hysteresis thresholds as a fraction of full intensity
+EDGE_THRESHOLDS = (0.1, 0.2)
+_ONE = np.ones((1, 1))
+_bleed_over = {}
+
+
+def _gaussian_kernel(sigma, truncate=4.0):
+    # Same kernel as scipy.ndimage
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma**2 * x**2)
+    return (kernel / kernel.sum()).reshape(-1, 1)
+
+
+def _presmooth(gray, sigma):
+    # ndi.gaussian_filter on uint8 truncates to uint8 after each axis
+    kernel = _gaussian_kernel(sigma)
+    smoothed = gray
+    for kernel_x, kernel_y in ((_ONE, kernel), (kernel, _ONE)):
+        smoothed = cv2.sepFilter2D(
+            smoothed, cv2.CV_64F, kernel_x, kernel_y, borderType=cv2.BORDER_REFLECT
+        )
+        smoothed += 1e-9
+        smoothed = smoothed.astype(np.uint8)
+    return smoothed
+
+
+def _smooth_normalized(gray, sigma):
+    """Gaussian of gray / 255 with zero padding, renormalized at the borders."""
+    kernel = _gaussian_kernel(sigma)
+    smoothed = cv2.sepFilter2D(
+        gray, cv2.CV_64F, kernel, kernel, borderType=cv2.BORDER_CONSTANT
+    )
+    key = (gray.shape, sigma)
+    if key not in _bleed_over:
+        ones = np.ones(gray.shape)
+        weight = cv2.sepFilter2D(
+            ones, -1, kernel, kernel, borderType=cv2.BORDER_CONSTANT
+        )
+        _bleed_over[key] = 255 * (weight + np.finfo(np.float64).eps)
+    return smoothed / _bleed_over[key]
+
+
+def detect_edges(gray, scale=1.0, sigma=EDGE_SIGMA, thresholds=EDGE_THRESHOLDS):
+    """Canny edges (0 or 255) of a grayscale uint8 image.
+
+    With scale < 1 the image is downscaled first and the edges are returned
+    at the reduced resolution.
+    """
+    if scale != 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    smoothed = _smooth_normalized(
+        _presmooth(gray, EDGE_PRESMOOTH_SIGMA * scale), sigma * scale
+    )
+    dx = cv2.Sobel(smoothed, cv2.CV_64F, 1, 0, ksize=3, borderType=cv2.BORDER_REFLECT)
+    dy = cv2.Sobel(smoothed, cv2.CV_64F, 0, 1, ksize=3, borderType=cv2.BORDER_REFLECT)
+    magnitude = cv2.magnitude(dx, dy)
+    height, width = gray.shape
+
+    # Non maximum suppression, only for pixels above the low threshold and
+    # not on the image border. The magnitude is interpolated between the two
+    # neighbours closest to the gradient direction on each side.
+    candidates = magnitude >= thresholds[0]
+    candidates[[0, -1], :] = False
+    candidates[:, [0, -1]] = False
+    index = np.flatnonzero(candidates)
+    flat = magnitude.ravel()
+    m = flat[index]
+    gx, gy = dx.ravel()[index], dy.ravel()[index]
+    ax, ay = np.abs(gx), np.abs(gy)
+    # Gradient in the 2nd / 4th quadrant (in row, column order)
+    anti = ((gy <= 0) & (gx >= 0)) | ((gy >= 0) & (gx <= 0))
+    # Closer to the column axis than to the row axis, within the quadrant
+    steep = np.where(anti, ay <= ax, ay >= ax)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(steep == anti, ay / ax, ax / ay)
+    straight = np.where(anti, np.where(steep, 1, -width), np.where(steep, width, 1))
+    diagonal = np.where(anti, 1 - width, width + 1)
+    with np.errstate(invalid="ignore"):
+        ahead = flat[index + diagonal] * weight + flat[index + straight] * (1 - weight)
+        behind = flat[index - diagonal] * weight + flat[index - straight] * (1 - weight)
+        maximum = (ahead <= m) & (behind <= m)
+    index, m = index[maximum], m[maximum]
+
+    # Hysteresis, keep the 8-connected weak edges that contain a strong one
+    weak = np.zeros(height * width, dtype=np.uint8)
+    weak[index] = 1
+    count, labels = cv2.connectedComponents(weak.reshape(height, width), connectivity=8)
+    strong = np.zeros(count, dtype=bool)
+    strong[labels.ravel()[index[m >= thresholds[1]]]] = True
+    strong[0] = False
+    return strong[labels].astype(np.uint8) * 255
+
+
+def find_edge_contours(gray, scale=1.0):
+    """External contours of the edges of gray, in full resolution pixels."""
+    edges = detect_edges(gray, scale)
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if scale != 1.0:
+        contours = [np.round(contour / scale).astype(np.int32) for contour in contours]
+    return contours, edges
+
+
+def classify_shape(contour):
+    """Shape name of a contour from its approximated polygon."""
+    x, y, w, h = cv2.boundingRect(contour)
+
+    # Approximate the contour to reduce the number of vertices
+    epsilon = 0.02 * cv2.arcLength(contour, True)
+    approx = cv2.approxPolyDP(contour, epsilon, True)
+    vertices = len(approx)
+
+    # Shape classification based on the contour vertices
+    shape = "Unknown"
+    if vertices == 6:
+        shape = "hexagon"
+    elif vertices == 4:
+        aspect_ratio = float(w) / h
+        shape = "cube" if 0.9 < aspect_ratio < 1.2 else "rectangle"
+    elif vertices > 0:
+        area = cv2.contourArea(contour)
+        perimeter = cv2.arcLength(contour, True)
+        circularity = (4 * np.pi * area) / (perimeter**2)
+        if circularity > 0.8:
+            shape = "cylinder"
+        else:
+            shape = "star_prism"
+    return shape
+
+
+def color_coverage(labels, contours, n_colors):
+    """Fraction of each contour's filled area covered by each color label.
+
+    Every contour is filled with its index into one mask, so the pixels per
+    contour and label come out of a single bincount. Returns [N, n_colors]
+    with column i for label i + 1.
+    """
+    index = np.zeros(labels.shape, dtype=np.int32)
+    for i, contour in enumerate(contours, start=1):
+        cv2.drawContours(index, [contour], -1, i, thickness=cv2.FILLED)
+    inside = index > 0
+    n_labels = n_colors + 1
+    counts = np.bincount(
+        index[inside] * n_labels + labels[inside],
+        minlength=(len(contours) + 1) * n_labels,
+    ).reshape(-1, n_labels)[1:]
+    area = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+    return counts[:, 1:] / area
+
+
+def label_colors(hsv, lut):
+    """Color label of every pixel of an HSV uint8 image in one lookup."""
+    # h * 65536 + s * 256 + v stays below 2**24, so float32 is exact
+    index = cv2.transform(hsv.astype(np.float32), _HSV_TO_INDEX).astype(np.int32)
+    return np.take(lut, index)
 
 
 @dataclass
@@ -52,38 +253,365 @@ class CameraDetection:
     angle: int
 
 
+@dataclass
+class DetectionBatch:
+    """Detections stored as columns, one array entry per detection.
+
+    color and shape are integer codes into the colors and shapes names of
+    the batch.
+    """
+
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+    global_x: np.ndarray
+    global_y: np.ndarray
+    global_z: np.ndarray
+    confidence: np.ndarray
+    size: np.ndarray
+    angle: np.ndarray
+    color: np.ndarray
+    shape: np.ndarray
+    colors: tuple = ()
+    shapes: tuple = ()
+
+    NUMERIC = (
+        "x",
+        "y",
+        "z",
+        "global_x",
+        "global_y",
+        "global_z",
+        "confidence",
+        "size",
+        "angle",
+    )
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def from_columns(cls, colors, shapes, **columns):
+        """Batch from numeric columns and color / shape names (any sequence
+        of strings). Missing numeric columns are zero."""
+        colors, color = np.unique(np.asarray(colors, dtype=str), return_inverse=True)
+        shapes, shape = np.unique(np.asarray(shapes, dtype=str), return_inverse=True)
+        n = len(color)
+        numeric = {
+            name: np.asarray(columns.get(name, np.zeros(n)), dtype=float).reshape(n)
+            for name in cls.NUMERIC
+        }
+        return cls(
+            **numeric,
+            color=color.astype(np.int16),
+            shape=shape.astype(np.int16),
+            colors=tuple(colors.tolist()),
+            shapes=tuple(shapes.tolist()),
+        )
+
+    @classmethod
+    def from_detections(cls, detections: List[CameraDetection]):
+        return cls.from_columns(
+            [d.color for d in detections],
+            [d.shape for d in detections],
+            **{name: [getattr(d, name) for d in detections] for name in cls.NUMERIC},
+        )
+
+    @classmethod
+    def concatenate(cls, batches):
+        batches = list(batches)
+        return cls.from_columns(
+            np.concatenate([b.color_names() for b in batches] + [[]]),
+            np.concatenate([b.shape_names() for b in batches] + [[]]),
+            **{
+                name: np.concatenate([getattr(b, name) for b in batches] + [[]])
+                for name in cls.NUMERIC
+            },
+        )
+
+    def color_names(self):
+        return np.asarray(self.colors, dtype=str)[self.color]
+
+    def shape_names(self):
+        return np.asarray(self.shapes, dtype=str)[self.shape]
+
+    def take(self, index):
+        """Batch of the detections selected by an index array or mask."""
+        return replace(
+            self,
+            **{name: getattr(self, name)[index] for name in self.NUMERIC},
+            color=self.color[index],
+            shape=self.shape[index],
+        )
+
+    def to_detections(self) -> List[CameraDetection]:
+        columns = {name: getattr(self, name).tolist() for name in self.NUMERIC}
+        colors = self.color_names().tolist()
+        shapes = self.shape_names().tolist()
+        return [
+            CameraDetection(
+                shape=shapes[i],
+                confidence=columns["confidence"][i],
+                x=columns["x"][i],
+                y=columns["y"][i],
+                z=columns["z"][i],
+                global_x=columns["global_x"][i],
+                global_y=columns["global_y"][i],
+                global_z=columns["global_z"][i],
+                size=columns["size"][i],
+                color=colors[i],
+                angle=int(columns["angle"][i]),
+            )
+            for i in range(len(self))
+        ]
+
+
+class FrameRingBuffer:
+    """Preallocated ring of frames written in place by the capture thread.
+
+    The writer fills next_slot() and then calls commit(), readers get the
+    latest frame with its sequence number and capture time (time.monotonic).
+    A slot is only overwritten after size - 1 newer frames, so views
+    returned with copy=False stay valid for that long.
+    """
+
+    def __init__(self, shape, size=4, dtype=np.uint8):
+        self.size = size
+        self.frames = np.zeros((size,) + tuple(shape), dtype=dtype)
+        self.timestamps = np.zeros(size)
+        self.sequence = -1
+        self._condition = threading.Condition()
+
+    def next_slot(self) -> np.ndarray:
+        return self.frames[(self.sequence + 1) % self.size]
+
+    def commit(self, timestamp):
+        with self._condition:
+            self.sequence += 1
+            self.timestamps[self.sequence % self.size] = timestamp
+            self._condition.notify_all()
+
+    def latest(self, copy=True):
+        with self._condition:
+            sequence = self.sequence
+        if sequence < 0:
+            return None, sequence, 0.0
+        slot = sequence % self.size
+        frame = self.frames[slot].copy() if copy else self.frames[slot]
+        return frame, sequence, self.timestamps[slot]
+
+    def wait_newer(self, timestamp, timeout=None, copy=True):
+        """Latest frame captured after timestamp, or (None, -1, 0.0) if none
+        arrives within timeout seconds."""
+        with self._condition:
+            arrived = self._condition.wait_for(
+                lambda: self.sequence >= 0
+                and self.timestamps[self.sequence % self.size] > timestamp,
+                timeout,
+            )
+        if not arrived:
+            return None, -1, 0.0
+        return self.latest(copy=copy)
+
+
 class Camera:
-    def __init__(self, index=1) -> None:
+    def __init__(
+        self,
+        index=1,
+        frame_timeout=2.0,
+        backend="ultralytics",
+        int8=False,
+        warm_up=True,
+        calibration_path=CALIBRATION_PATH,
+    ) -> None:
         self.index = index
+        self.frame_timeout = frame_timeout
         self.width = 640
         self.height = 480
-        self.model = YOLO(
-            Path().cwd() / "neural_network" / "weights" / "best_new_data.pt"
-        )
-        self.frame_queue = queue.Queue(maxsize=10)
+        if backend not in ("ultralytics", "onnx"):
+            raise ValueError(f"Unknown detector backend: {backend}")
+        self.backend = backend
+        self.int8 = int8
+        # Loading the detector takes seconds, so it happens in the background
+        # (or on first use with warm_up=False) while frames are captured
+        self._model = BackgroundLoader("detector", self._load_model, start=warm_up)
+        self.set_color_ranges(COLOR_RANGES)
+        # Image to table mapping, the fixed scale unless there is a
+        # calibration. Calibrated frames are undistorted as they are captured.
+        self.table_model = LinearTableModel()
+        self.undistort = None
+        self.load_calibration(calibration_path)
+        self.frames = FrameRingBuffer((self.height, self.width, 3))
+        self._stop = threading.Event()
         self.capture_thread = threading.Thread(target=self._capture_frames)
         self.capture_thread.daemon = True
         self.capture_thread.start()
 
+    def _load_model(self):
+        weights = Path().cwd() / "neural_network" / "weights" / "best_new_data.pt"
+        if self.backend == "onnx":
+            # ONNX Runtime is only needed for this backend
+            from onnx_detector import OnnxDetector, export_onnx
+
+            onnx_path = weights.with_name(
+                weights.stem + ("_int8.onnx" if self.int8 else ".onnx")
+            )
+            if not onnx_path.exists():
+                onnx_path = export_onnx(weights, quantize=self.int8)
+            model = OnnxDetector(onnx_path)
+        else:
+            from ultralytics import YOLO
+
+            model = YOLO(weights)
+        # The first inference initializes the backend, do it before it counts
+        model(np.zeros((self.height, self.width, 3), dtype=np.uint8), verbose=False)
+        return model
+
+    @property
+    def model(self):
+        return self._model.get()
+
+    def is_ready(self):
+        return self._model.ready
+
+    def wait_until_ready(self, timeout=None):
+        """Block until the detector is loaded, True if it loaded successfully."""
+        try:
+            self._model.get(timeout)
+        except Exception:
+            return False
+        return True
+
+    @property
+    def status(self):
+        return self._model.status
+
+    def set_color_ranges(self, color_ranges, min_brightness=MIN_BRIGHTNESS):
+        """Change the HSV ranges of the classical detector, see COLOR_RANGES."""
+        self.color_ranges = dict(color_ranges)
+        self.color_lut = build_color_lut(self.color_ranges, min_brightness)
+
+    def load_calibration(self, path=CALIBRATION_PATH):
+        calibration = load_calibration(path)
+        if calibration is None:
+            return False
+        width, height = calibration["image_size"]
+        if (width, height) != (self.width, self.height):
+            print(
+                f"Warn: Calibration is for {width}x{height}, camera is "
+                f"{self.width}x{self.height}, not using it"
+            )
+            return False
+        self.undistort = Undistorter(
+            calibration["camera_matrix"], calibration["dist_coeffs"], (width, height)
+        )
+        # Frames are undistorted already, the homography applies directly
+        self.table_model = HomographyTableModel(
+            calibration["homography"], width, height
+        )
+        print(f"Loaded camera calibration from {path}")
+        return True
+
     def _capture_frames(self):
+        # cap.read blocks until the camera delivers a frame, so the loop runs
+        # at the camera frame rate. Failed reads back off exponentially and
+        # the camera is reopened every 10 failures.
         cap = cv2.VideoCapture(self.index)
-        while True:
-            ret, frame = cap.read()
+        failures = 0
+        raw = None
+        while not self._stop.is_set():
+            slot = self.frames.next_slot()
+            # With undistortion the camera writes to a scratch frame that is
+            # remapped into the slot
+            undistort = self.undistort
+            ret, frame = cap.read(image=slot if undistort is None else raw)
             if not ret or frame is None:
-                print("Error: Could not open image.")
+                if failures == 0:
+                    print("Error: Could not open image.")
+                failures += 1
+                if failures % 10 == 0:
+                    cap.release()
+                    cap = cv2.VideoCapture(self.index)
+                self._stop.wait(min(0.01 * 2**failures, 2.0))
+                continue
+            failures = 0
+            if frame.shape != slot.shape:
+                # Camera does not deliver the configured resolution
+                self.height, self.width = frame.shape[:2]
+                self.frames = FrameRingBuffer(frame.shape, size=self.frames.size)
                 continue
-            if not self.frame_queue.full():
-                self.frame_queue.put(frame)
-            time.sleep(0.01)  # Add a small delay to avoid busy-waiting
-
-    def grab_frame(self):
-        retries = 20
-        while retries > 0:
-            if not self.frame_queue.empty():
-                return self.frame_queue.get()
-            retries -= 1
-            time.sleep(0.1)  # Wait for a short time before retrying
-        raise Exception("Error: No frames available.")
+            if undistort is not None and frame.shape[1::-1] == undistort.size:
+                raw = frame
+                undistort(frame, out=slot)
+            elif frame is not slot:
+                slot[...] = frame
+            self.frames.commit(time.monotonic())
+        cap.release()
+
+    def close(self):
+        self._stop.set()
+        self.capture_thread.join()
+
+    def grab_latest(self, copy=True):
+        """Latest frame with its sequence number and capture timestamp."""
+        return self.frames.latest(copy=copy)
+
+    def wait_for_frame(self, newer_than, timeout=None, copy=True):
+        """Latest frame once one captured after newer_than (time.monotonic)
+        is available, (None, -1, 0.0) on timeout."""
+        if timeout is None:
+            timeout = self.frame_timeout
+        return self.frames.wait_newer(newer_than, timeout=timeout, copy=copy)
+
+    def grab_frame(self, timeout=None):
+        # Returns immediately if a frame has been captured, otherwise wakes up
+        # as soon as the first one lands
+        frame, _, _ = self.wait_for_frame(float("-inf"), timeout=timeout)
+        if frame is None:
+            raise Exception("Error: No frames available.")
+        return frame
+
+    def grab_settled_frame(
+        self, max_wait=2.0, threshold=2.0, settle_frames=2, scale=8, since=None
+    ):
+        """First frame after the image has stopped moving.
+
+        Consecutive frames captured after since (time.monotonic, default now)
+        are downscaled by scale and compared, the view counts as still when
+        the mean absolute gray level difference is below threshold for
+        settle_frames frames in a row. Gives up after max_wait seconds and
+        returns the latest frame.
+        """
+        deadline = time.monotonic() + max_wait
+        last_timestamp = time.monotonic() if since is None else since
+        previous = None
+        still = 0
+        frame = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            frame, _, timestamp = self.wait_for_frame(
+                last_timestamp, timeout=remaining, copy=False
+            )
+            if frame is None:
+                break
+            last_timestamp = timestamp
+            small = cv2.resize(
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                (frame.shape[1] // scale, frame.shape[0] // scale),
+                interpolation=cv2.INTER_AREA,
+            )
+            if previous is not None:
+                difference = cv2.absdiff(small, previous).mean()
+                still = still + 1 if difference < threshold else 0
+                if still >= settle_frames:
+                    return frame.copy()
+            previous = small
+        print("Warn: Camera did not settle")
+        if frame is None:
+            return self.grab_frame()
+        return frame.copy()
 
     def run_object_detection(self, frame=None):
         if frame is None:
@@ -115,7 +643,13 @@ class Camera:
                 )
         return frame
 
-    def get_detected_objects(self, angle: int, frame=None) -> List[CameraDetection]:
+    def get_detected_objects(
+        self, angle: int, frame=None, edge_scale=1.0
+    ) -> List[CameraDetection]:
+        """Classical detector, color from HSV ranges and shape from edges.
+
+        edge_scale < 1 runs the edge detection on a downscaled frame.
+        """
         if frame is None:
             frame = self.grab_frame()
 
@@ -123,137 +657,79 @@ class Camera:
         # Apply median filter to reduce noise
         median_frame = cv2.GaussianBlur(frame, (5, 5), 0)
 
-        # Convert the frame to HSV color space for color-based foreground masking
-        # and Define color ranges for white, red, blue, and green
+        # Label every pixel with its color (0 is background) in one pass
         hsv = cv2.cvtColor(median_frame, cv2.COLOR_BGR2HSV)
-        color_ranges = {
-            "white": ((0, 0, 200), (180, 20, 255)),
-            "red": ((0, 90, 80), (180, 255, 255)),
-            "blue": ((100, 120, 70), (140, 255, 255)),
-            "green": ((40, 50, 50), (90, 255, 255)),
-        }
-
-        mask_bright = cv2.inRange(hsv, (0, 0, 140), (180, 255, 255))
-        masks = {}
-        for color, (lower, upper) in color_ranges.items():
-            mask = cv2.inRange(hsv, lower, upper)
-            if color != "white":  # Apply brightness filter to all non-white
-                mask = cv2.bitwise_and(mask, mask_bright)
-            masks[color] = mask
-            # cv2.imshow(f"{color.capitalize()} Mask", mask)
-
-        # Sharpen red mask specifically
-        kernel_sharpening = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+        labels = label_colors(hsv, self.color_lut)
 
-        masks["red"] = cv2.filter2D(masks["red"], -1, kernel_sharpening)
+        # Reduce noise with morphological operations on all colors at once
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-
-        # Reduce noise with morphological operations
-        for color, mask in masks.items():
-            # cv2.imshow(f"{color} Mask", mask)
-
-            # Opening to remove small noise
-            masks[color] = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=2)
-            # Closing to fill small holes in the object
-            masks[color] = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
-            # Visualize each color mask
-            # cv2.imshow(f"{color} Mask", masks[color])
-
-        # for color, mask in masks.items():
-        #     cv2.imshow(f"{color} Mask", mask)  # Visualize each mask
-
-        # Combine all masks to create a foreground mask
-        combined_mask = np.zeros_like(masks["white"])
-        for color in ["white", "red", "blue", "green"]:
-            combined_mask = cv2.bitwise_or(combined_mask, masks[color])
-
-            # cv2.imshow(
-            #     "Combined Mask", combined_mask
-            # )  # Add this after combining all color masks
-
+        _, combined_mask = cv2.threshold(labels, 0, 255, cv2.THRESH_BINARY)
+        combined_mask = cv2.morphologyEx(
+            combined_mask, cv2.MORPH_OPEN, kernel, iterations=2
+        )
+        labels = cv2.bitwise_and(labels, combined_mask)
+        # Closing to fill small holes in the objects
+        combined_mask = cv2.morphologyEx(
+            combined_mask, cv2.MORPH_CLOSE, kernel, iterations=2
+        )
         # Apply the mask to the frame to remove the background
         foreground = cv2.bitwise_and(frame, frame, mask=combined_mask)
 
-        # Apply Canny edge detection to the foreground
+        # Apply Canny edge detection to the frame
         gray_image = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        im_noisy = ndi.gaussian_filter(gray_image, 4)
-        edges = feature.canny(im_noisy, sigma=3.5)
-        edges_display = (edges * 255).astype(np.uint8)
-        # cv2.imshow("Canny Edges", edges_display)
-
-        # Find contours in the Canny edge-detected image
-        canny_contours, _ = cv2.findContours(
-            edges_display, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-        )
+        canny_contours, _ = find_edge_contours(gray_image, scale=edge_scale)
+
+        contours = [
+            contour
+            for contour in canny_contours
+            if cv2.contourArea(contour) > 2000  # Filter by area to avoid small noise
+        ]
+        # Color coverage of every contour at once
+        colors = list(self.color_ranges)
+        coverage = color_coverage(labels, contours, len(colors))
 
         # Draw the Canny contours (on the color foreground)
-        for contour in canny_contours:
-            if cv2.contourArea(contour) > 2000:  # Filter by area to avoid small noise
-                x, y, w, h = cv2.boundingRect(contour)
-
-                # Approximate the contour to reduce the number of vertices
-                epsilon = 0.02 * cv2.arcLength(contour, True)
-                approx = cv2.approxPolyDP(contour, epsilon, True)
-                vertices = len(approx)
-
-                # Shape classification based on the contour vertices
-                shape = "Unknown"
-                if vertices == 6:
-                    shape = "hexagon"
-                elif vertices == 4:
-                    aspect_ratio = float(w) / h
-                    shape = "cube" if 0.9 < aspect_ratio < 1.2 else "rectangle"
-                elif vertices > 0:
-                    area = cv2.contourArea(contour)
-                    perimeter = cv2.arcLength(contour, True)
-                    circularity = (4 * np.pi * area) / (perimeter**2)
-                    if circularity > 0.8:
-                        shape = "cylinder"
-                    else:
-                        shape = "star_prism"
-                else:
-                    if vertices > 8:
-                        shape = "star_prism"
-
-                # Detect color in the bounding box
-                max_coverage = 0
-                for color, mask in masks.items():
-                    mask_region = mask[y : y + h, x : x + w]
-                    non_zero_pixels = cv2.countNonZero(mask_region)
-                    coverage = non_zero_pixels / mask_region.size
-                    if coverage > max_coverage:
-                        max_coverage = coverage
-                        shape_color = color
-
-                # Draw the contour on the color foreground (in blue) and label it
-                cv2.drawContours(foreground, [contour], -1, (255, 0, 0), 2)
-                cv2.putText(
-                    foreground,
-                    f"{shape_color} {shape} ",
-                    (x, y - 10),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.5,
-                    (255, 255, 255),
-                    2,
-                )
+        for contour, contour_coverage in zip(contours, coverage):
+            x, y, w, h = cv2.boundingRect(contour)
+            shape = classify_shape(contour)
+
+            # Color covering most of the object
+            max_coverage = float(contour_coverage.max())
+            if max_coverage > 0:
+                shape_color = colors[contour_coverage.argmax()]
+            else:
+                shape_color = "Unknown"
+
+            # Draw the contour on the color foreground (in blue) and label it
+            cv2.drawContours(foreground, [contour], -1, (255, 0, 0), 2)
+            cv2.putText(
+                foreground,
+                f"{shape_color} {shape} ",
+                (x, y - 10),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                (255, 255, 255),
+                2,
+            )
 
-                x = x / self.width - 0.5
-                y = -1 * (y / self.height - 0.5)
-                w = w / self.width
-                h = h / self.height
-                entry = CameraDetection(
-                    shape=shape,
-                    x=x + w / 2,
-                    y=y - h / 2,
-                    z=0,
-                    size=w * h,
-                    color=shape_color,
-                    global_x=0,
-                    global_y=0,
-                    global_z=0,
-                    angle=angle,
-                )
-                results.append(entry)
+            x = x / self.width - 0.5
+            y = -1 * (y / self.height - 0.5)
+            w = w / self.width
+            h = h / self.height
+            entry = CameraDetection(
+                shape=shape,
+                confidence=max_coverage,
+                x=x + w / 2,
+                y=y - h / 2,
+                z=0,
+                size=w * h,
+                color=shape_color,
+                global_x=0,
+                global_y=0,
+                global_z=0,
+                angle=angle,
+            )
+            results.append(entry)
         cv2.imshow("Detected Objects", foreground)
 
         print(f"GOT {len(results)} DETECTIONS")
@@ -264,66 +740,18 @@ class Camera:
         ##### HELLO
 
     def get_detected_objects_from_nn(
-        self, angle: int, frame=None
+        self, angle: int, frame=None, show=True
     ) -> List[CameraDetection]:
-        frame = self.grab_frame()
         if frame is None:
             frame = self.grab_frame()
 
         results = self.model(frame, stream=True)
         detections = []
         for r in results:
-            boxes = r.boxes
-            for box in boxes:
-                if box.conf[0] < 0.8:
-                    continue
-
-                x1, y1, x2, y2 = box.xyxy[0]
-                x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-                w, h = x2 - x1, y2 - y1
-                if w / h < 0.7 or w / h > 1.3:
-                    continue
-
-                cvzone.cornerRect(frame, (x1, y1, w, h))
-
-                conf = math.ceil((box.conf[0] * 100)) / 100
-
-                cls = box.cls[0]
-                name = classNames[int(cls)]
-
-                cvzone.putTextRect(
-                    frame,
-                    f"{name} " f"{conf}",
-                    (max(0, x1), max(35, y1)),
-                    scale=0.5,
-                    thickness=1,
-                )
-
-                cls = box.cls[0]
-                classification = classNames[int(cls)].split()
-                color = classification[0]
-                shape = classification[1]
-
-                x = x1 / self.width - 0.5
-                y = -1 * (y1 / self.height - 0.5)
-                w = w / self.width
-                h = h / self.height
-                entry = CameraDetection(
-                    shape=shape,
-                    confidence=conf,
-                    x=x + w / 2,
-                    y=y - h / 2,
-                    z=0,
-                    size=w * h,
-                    color=color,
-                    global_x=0,
-                    global_y=0,
-                    global_z=0,
-                    angle=angle,
-                )
-                detections.append(entry)
-        cv2.imshow("frame", frame)
-        cv2.waitKey(1)
+            detections.extend(self._detections_from_boxes(r.boxes, frame, angle))
+        if show:
+            cv2.imshow("frame", frame)
+            cv2.waitKey(1)
         print(f"Angle: {angle}")
 
         for detection in detections:
@@ -332,68 +760,145 @@ class Camera:
             )
         return self.get_global_position(detections, camera_angle=angle)
 
-    def get_global_position(self, objects: List[CameraDetection], camera_angle: int):
-
-        # length_per_pixel_x = 0.071 * 2
-        # length_per_pixel_y = 0.098 * 2
-        # mid_x_pos = 0.132
-        mid_x_pos = 0.14
-        length_per_pixel_x = 0.098 * 2
-        length_per_pixel_y = 0.138 * 2
-        for object in objects:
-            object.global_y = np.sin(np.deg2rad(camera_angle)) * mid_x_pos + (
-                -1 * object.x * length_per_pixel_x * np.cos(np.deg2rad(camera_angle))
-                + object.y * length_per_pixel_y * np.sin(np.deg2rad(camera_angle))
-            )
-            object.global_x = (
-                np.cos(np.deg2rad(camera_angle)) * mid_x_pos
-                + object.y * length_per_pixel_y * np.cos(np.deg2rad(camera_angle))
-                + object.x * length_per_pixel_x * np.sin(np.deg2rad(camera_angle))
-            )
-            print(
-                f"Object with shape {object.shape} at x: {object.x}, y: {object.y} and angle {camera_angle}\n has global x: {object.global_x}, global y: {object.global_y}"
+    def get_detected_objects_from_nn_batch(
+        self, frames, angles
+    ) -> List[CameraDetection]:
+        """Run the detector once on all frames of a scan.
+
+        Each detection gets the angle of the frame it was found in and is
+        mapped to a global position with that angle.
+        """
+        results = self.model(list(frames), stream=False)
+        batches = []
+        for r, frame, angle in zip(results, frames, angles):
+            batches.append(self._batch_from_boxes(r.boxes, frame, angle))
+            print(f"Angle: {angle}, {len(batches[-1])} detections")
+        batch = DetectionBatch.concatenate(batches)
+        return self.get_global_position_batch(batch).to_detections()
+
+    def _detections_from_boxes(self, boxes, frame, angle) -> List[CameraDetection]:
+        return self._batch_from_boxes(boxes, frame, angle).to_detections()
+
+    def _batch_from_boxes(self, boxes, frame, angle) -> DetectionBatch:
+        # x1, y1, x2, y2, confidence, class per box
+        rows = np.array(
+            [
+                [float(v) for v in box.xyxy[0]]
+                + [float(box.conf[0]), float(box.cls[0])]
+                for box in boxes
+            ],
+            dtype=float,
+        ).reshape(-1, 6)
+        x1, y1, x2, y2 = rows[:, :4].astype(int).T
+        w, h = x2 - x1, y2 - y1
+        aspect = w / np.maximum(h, 1)
+        keep = (rows[:, 4] >= 0.8) & (h > 0) & (aspect >= 0.7) & (aspect <= 1.3)
+        x1, y1, w, h = x1[keep], y1[keep], w[keep], h[keep]
+        conf = np.ceil(rows[keep, 4] * 100) / 100
+        cls = rows[keep, 5].astype(int)
+
+        for i in range(len(cls)):
+            cvzone.cornerRect(frame, (x1[i], y1[i], w[i], h[i]))
+            cvzone.putTextRect(
+                frame,
+                f"{classNames[cls[i]]} " f"{conf[i]}",
+                (max(0, x1[i]), max(35, y1[i])),
+                scale=0.5,
+                thickness=1,
             )
 
+        x = x1 / self.width - 0.5
+        y = -1 * (y1 / self.height - 0.5)
+        w = w / self.width
+        h = h / self.height
+        return DetectionBatch.from_columns(
+            _CLASS_COLORS[cls],
+            _CLASS_SHAPES[cls],
+            x=x + w / 2,
+            y=y - h / 2,
+            size=w * h,
+            confidence=conf,
+            angle=np.full(len(cls), angle),
+        )
+
+    def get_global_position(self, objects: List[CameraDetection], camera_angle: int):
+        batch = DetectionBatch.from_detections(objects)
+        batch.angle[:] = camera_angle
+        self.get_global_position_batch(batch)
+        for object, global_x, global_y in zip(objects, batch.global_x, batch.global_y):
+            object.global_x = float(global_x)
+            object.global_y = float(global_y)
         return objects
 
+    def get_global_position_batch(self, batch: DetectionBatch) -> DetectionBatch:
+        """Set the global position of every detection from its image position
+        and camera angle, in place."""
+        if len(batch):
+            batch.global_x, batch.global_y = camera_to_world(
+                self.table_model, batch.x, batch.y, batch.angle
+            )
+        return batch
+
     def merge_objects(
         self, camera_detections: List[CameraDetection], distance_threshold
     ):
-
-        merged_points = []
-
-        while camera_detections:
-            point = camera_detections.pop(0)
-            cluster = [point]
-            idx_to_remove = []
-            for idx, other_point in enumerate(camera_detections):
-                dist = np.sqrt(
-                    (point.global_x - other_point.global_x) ** 2
-                    + (point.global_y - other_point.global_y) ** 2
-                )
-                if (
-                    (dist <= distance_threshold)
-                    and (point.color == other_point.color)
-                    and (point.shape == other_point.shape)
-                ):
-                    cluster.append(other_point)
-                    idx_to_remove.append(idx)
-
-            # Merge all points in the cluster into a single point (average of the cluster)
-            if len(cluster) > 1:
-                best_shape_index = np.argmax([p.confidence for p in cluster])
-                avg_x = sum(p.global_x for p in cluster) / len(cluster)
-                avg_y = sum(p.global_y for p in cluster) / len(cluster)
-                cluster[0].global_x = avg_x
-                cluster[0].global_y = avg_y
-                cluster[0].shape = cluster[best_shape_index].shape
-                merged_points.append(cluster[0])
-            else:
-                merged_points.append(point)
-            for idx in sorted(idx_to_remove, reverse=True):
-                camera_detections.pop(idx)
-
-        return merged_points
+        return merge_detections(camera_detections, distance_threshold)
+
+
+def merge_detections(
+    detections: List[CameraDetection], distance_threshold
+) -> List[CameraDetection]:
+    batch = DetectionBatch.from_detections(detections)
+    return merge_batch(batch, distance_threshold).to_detections()
+
+
+def merge_batch(batch: DetectionBatch, distance_threshold) -> DetectionBatch:
+    """Merge detections of the same object seen from several angles.
+
+    Detections of the same color and shape closer than distance_threshold
+    are linked, and every connected group becomes one detection at the
+    confidence weighted mean position. The result does not depend on the
+    order of the input and comes out sorted by position.
+    """
+    n = len(batch)
+    if n == 0:
+        return batch
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+
+    positions = np.stack([batch.global_x, batch.global_y, batch.global_z], axis=1)
+
+    # Neighbour pairs in the table plane, only the same kind of object links
+    pairs = cKDTree(positions[:, :2]).query_pairs(
+        distance_threshold, output_type="ndarray"
+    )
+    pairs = pairs[
+        (batch.color[pairs[:, 0]] == batch.color[pairs[:, 1]])
+        & (batch.shape[pairs[:, 0]] == batch.shape[pairs[:, 1]])
+    ]
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), (n, n))
+    n_clusters, cluster = connected_components(graph, directed=False)
+
+    weights = np.maximum(batch.confidence, 1e-9)
+    weight_sum = np.bincount(cluster, weights, n_clusters)
+    centroids = np.stack(
+        [
+            np.bincount(cluster, weights * positions[:, axis], n_clusters)
+            for axis in range(3)
+        ],
+        axis=1,
+    )
+    centroids /= weight_sum[:, None]
+
+    # Most confident detection of each cluster, ties go to the lower index
+    order = np.lexsort((np.arange(n), -batch.confidence, cluster))
+    best = order[np.r_[0, np.flatnonzero(np.diff(cluster[order])) + 1]]
+
+    by_position = np.lexsort((centroids[:, 1], centroids[:, 0]))
+    merged = batch.take(best[by_position])
+    merged.global_x, merged.global_y, merged.global_z = centroids[by_position].T
+    return merged
 
 
 if __name__ == "__main__":